@@ -0,0 +1,175 @@
+"""
+Benchmark suite for the detector and classifier stages across camera resolutions.
+
+Frames are synthetic and seeded so runs are comparable between machines, OpenCV versions and config changes.
+Results are written as JSON and can be compared against a saved baseline. Run from the prey_lock directory:
+    python -m benchmarks.suite --save baseline.json
+    python -m benchmarks.suite --compare baseline.json
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from detector.motion_detector import MotionDetector
+
+CASCADE_DIR = Path(__file__).resolve().parents[2].joinpath('cascades')
+RESOLUTIONS = {
+    '480p': (640, 480),
+    '720p': (1280, 720),
+    '1080p': (1920, 1080),
+    '4k': (3840, 2160),
+}
+REGRESSION_THRESHOLD = 0.10 # Slower than the baseline by more than this fraction counts as a regression
+
+
+# A smooth random "scene" rather than pure noise so the cascades behave more like they would on a real frame,
+# plus a bright block that moves a little each frame so there's always motion to find.
+def make_scene(width, height, count, seed=0):
+    rng = np.random.default_rng(seed)
+    coarse = rng.integers(0, 256, (height // 16, width // 16, 3), np.uint8)
+    bg = cv2.resize(coarse, (width, height), interpolation=cv2.INTER_CUBIC)
+
+    frames = []
+    block_w = width // 8
+    for i in range(count):
+        frame = bg.copy()
+        x = (i * block_w // 2) % (width - block_w)
+        frame[height // 3:height // 2, x:x + block_w] = 255
+        frames.append(frame)
+
+    return bg, frames
+
+
+def time_stage(fn, iterations, repeats) -> dict:
+    fn() # Warm up
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            fn()
+        times.append((time.perf_counter() - start) / iterations * 1000)
+
+    return {
+        'min_ms': round(min(times), 4),
+        'median_ms': round(float(np.median(times)), 4),
+    }
+
+
+def bench_motion_detector(bg, frame, args) -> dict:
+    detector = MotionDetector(0.02, args.scale, MotionDetector.BG_SNAPSHOT, preallocate=args.preallocate)
+    detector.set_bg_frame(bg)
+    detector.set_compare_frame(frame)
+
+    return {
+        'prepare_frame': time_stage(lambda: detector.prepare_frame(frame, 'compare'), args.iterations, args.repeats),
+        'get_threshold': time_stage(detector.get_threshold, args.iterations, args.repeats),
+        'movement_detected': time_stage(detector.movement_detected, args.iterations, args.repeats),
+    }
+
+
+def bench_cascades(frame, args) -> dict:
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    results = {}
+    for cascade_file in sorted(CASCADE_DIR.glob('*.xml')):
+        cascade = cv2.CascadeClassifier(str(cascade_file))
+
+        def detect(cascade=cascade):
+            cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=3, minSize=(75, 75))
+
+        results[cascade_file.stem] = time_stage(detect, args.cascade_iterations, args.repeats)
+
+    return results
+
+
+def run_suite(args) -> dict:
+    results = {}
+    for name in args.resolutions:
+        (width, height) = RESOLUTIONS[name]
+        bg, frames = make_scene(width, height, 2)
+        for stage, stats in bench_motion_detector(bg, frames[1], args).items():
+            results[f'{name}/motion/{stage}'] = stats
+
+        if not args.skip_cascades:
+            for cascade, stats in bench_cascades(frames[1], args).items():
+                results[f'{name}/cascade/{cascade}'] = stats
+
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'opencv': cv2.__version__,
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'cv_threads': cv2.getNumThreads(),
+            'scale': args.scale,
+            'preallocate': args.preallocate,
+        },
+        'results': results,
+    }
+
+
+# Returns True if anything got slower than the threshold allows
+def compare(current: dict, baseline: dict, threshold) -> bool:
+    regressed = False
+    print(f"{'benchmark':<55}{'baseline ms':>12}{'current ms':>12}{'change':>9}")
+    for key, stats in current['results'].items():
+        if key not in baseline['results']:
+            print(f"{key:<55}{'-':>12}{stats['min_ms']:>12.3f}{'new':>9}")
+            continue
+
+        before = baseline['results'][key]['min_ms']
+        after = stats['min_ms']
+        change = (after - before) / before if before > 0 else 0.0
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressed = True
+
+        print(f"{key:<55}{before:>12.3f}{after:>12.3f}{change:>+9.1%}{flag}")
+
+    for key in baseline['results'].keys() - current['results'].keys():
+        print(f"{key:<55}{'missing from current run':>33}")
+
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark detector and classifier stages')
+    parser.add_argument('--resolutions', nargs='+', choices=list(RESOLUTIONS), default=list(RESOLUTIONS))
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--cascade-iterations', type=int, default=1)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--scale', type=float, default=MotionDetector.ANALYSIS_SCALE)
+    parser.add_argument('--preallocate', action='store_true')
+    parser.add_argument('--skip-cascades', action='store_true')
+    parser.add_argument('--output', help='Write the results JSON here instead of stdout')
+    parser.add_argument('--save', help='Save the results as a baseline for later comparisons')
+    parser.add_argument('--compare', help='Baseline JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD)
+    args = parser.parse_args()
+
+    results = run_suite(args)
+
+    for path in (args.output, args.save):
+        if path:
+            with open(path, 'w') as out:
+                json.dump(results, out, indent=4)
+
+    if args.compare:
+        with open(args.compare, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+    elif not (args.output or args.save):
+        print(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
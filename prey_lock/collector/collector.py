@@ -9,99 +9,230 @@ import datetime
 import logging
 import json
 import os
+from concurrent.futures import Future
 from pathlib import Path
 
-from detector.camera import Camera
-from detector.motion_detector import MotionDetector
+from detector.camera_pool import CameraPool, CameraStream
+from detector.dedup import DuplicateFilter
+from detector.image_encoder import ImageEncoder
+from detector.motion_events import MotionEvent
 from google_drive.drive import Drive
+from google_drive.spool import UploadSpool
+from google_drive.uploader import Uploader
+from metrics.stats import StatsWriter, stats, timed
+from pipeline.pipeline import Pipeline
 
 class Collector:
     CONFIG_PATH = "../config/detection_zone.json"    
-    TEMP_PATH = "./collector/temp"
-    UPLOAD_FREQUENCY = 60 # in seconds
+    DETECTOR_CONFIG_PATH = '../config/detector.json'
+    UPLOAD_FREQUENCY = 60 # in seconds, only used by the pipeline. Otherwise EVENTS decides what gets uploaded.
     CAMERA_POS_UPDATE_FREQ = 14 # in days
+    DECODE_EVERY = 2 # Only decode every nth frame from the camera. Replaced by SAMPLING once a stream is running.
+    MAX_WORKERS = 2 # Detection threads shared by all of the cameras
+    DETECTOR_OPTIONS = {
+        'preallocate': True,
+    }
+    # Taken from the motion_detector section of DETECTOR_CONFIG_PATH so the collector detects motion the same way
+    # as everything else. Uploads are still full size whatever analysis_scale is.
+    DETECTOR_CONFIG_KEYS = ('analysis_scale', 'bg_mode', 'learning_rate')
+    SAMPLING = {
+        'active_fps': 15, # Frames per second checked while there's motion about
+        'idle_fps': 2, # and once there hasn't been any for idle_after seconds
+        'idle_after': 10,
+        'cpu_budget': 0.5, # Fraction of a core each camera's detection may use
+    }
+    STATS_FREQUENCY = 300 # in seconds
+    STATS_PATH = './logs/stats.prom'
+    STATS_WRITE_FREQUENCY = 60 # in seconds
+    JPEG_QUALITY = 90
+    DEDUP = {
+        'max_distance': 6, # Frames whose hashes are this many bits apart or fewer aren't uploaded twice
+        'capacity': 64, # Recent uploads remembered per camera
+    }
+    EVENTS = {
+        'start_frames': 2, # Motion frames in a row before an event starts
+        'end_after': 5.0, # Seconds without motion before it ends
+        'max_duration': 60.0, # Longer events are split up
+        'top_k': 3, # Best frames uploaded per event
+    }
+    CLIPS = {
+        'pre_roll': 5.0, # Seconds of video kept from before motion was noticed
+        'post_roll': 5.0, # and recorded after it stops
+        'max_buffer_bytes': 16 * 1024 * 1024, # RAM for each camera's pre-roll
+        'max_disk_bytes': 500 * 1024 * 1024, # Disk for each camera's clips, the oldest are deleted
+    }
+    SPOOL_PATH = './spool/uploads.db'
+    SPOOL_MAX_BYTES = 200 * 1024 * 1024
+    LOG_PATH = './logs/collector.txt'
+    PIPELINE_SLOT_SHAPE = None # Largest (height, width, 3) frame the pipeline can pass on. None sizes it per camera.
     
-    def __init__(self) -> None:
+    # With pipeline set, capture, detection, encoding and uploading each run in their own processes instead of
+    # threads in this one, see Pipeline
+    def __init__(self, pipeline=False) -> None:
         with open('../env.json') as env_file:
             env = json.load(env_file)
 
-        RTSP = f"rtsp://{env['USER']}:{env['PASS']}@{env['RTSP_URL']}"
-
-        self.cam: Camera = Camera(RTSP)
-        self.drive = Drive()
-
-        with open(self.CONFIG_PATH, 'r') as config_file:
-            self.config = json.load(config_file)
-        
-        self.detector: MotionDetector = MotionDetector(self.config['sensitivity'])
-        self.bg_reset_frames = Camera.FPS
-        self.last_upload_time = None
-
-    def crop_frame(self, frame: np.ndarray):
-        frame_shape = frame.shape
-        x1 = round(self.config['topleft'][0] * frame_shape[1])
-        y1 = round(self.config['topleft'][1] * frame_shape[0])
-        x2 = round((self.config['topleft'][0] + self.config['width']) * frame_shape[1])
-        y2 = round((self.config['topleft'][1] + self.config['height']) * frame_shape[0])
-
-        return frame[y1:y2, x1:x2]
+        stats.enable()
+        self.detector_options = self.get_detector_options()
+        self.stats_writer = StatsWriter(self.STATS_PATH, self.STATS_WRITE_FREQUENCY, StatsWriter.FORMAT_PROMETHEUS)
+
+        self.pipeline = None
+        if pipeline:
+            self.pipeline = Pipeline(
+                self.current_sources(env),
+                self.detector_options,
+                self.SAMPLING,
+                self.UPLOAD_FREQUENCY,
+                self.DEDUP,
+                self.SPOOL_PATH,
+                self.SPOOL_MAX_BYTES,
+                quality=self.JPEG_QUALITY,
+                slot_shape=self.PIPELINE_SLOT_SHAPE,
+                log_path=self.LOG_PATH
+            )
+            return
 
-    def settings_stale(self) -> bool:
-        last_updated = datetime.datetime.strptime(self.config['last_updated'], '%Y-%m-%d %H:%M:%S')
+        # Uploads happen on the uploader's thread, which is the only one that touches the Drive client. Images
+        # wait in the spool until they've been uploaded so an outage or a restart doesn't lose them.
+        self.uploader = Uploader(Drive(), spool=UploadSpool(self.SPOOL_PATH, self.SPOOL_MAX_BYTES))
+        self.encoder = ImageEncoder.shared(quality=self.JPEG_QUALITY)
+
+        # Motion is grouped into events and only the best few frames of each get uploaded, see EventSegmenter
+        self.pool = CameraPool(
+            self.get_sources(env),
+            None,
+            self.MAX_WORKERS,
+            self.DECODE_EVERY,
+            self.detector_options,
+            self.SAMPLING,
+            self.upload_event,
+            self.EVENTS,
+            self.CLIPS
+        )
+        self.duplicate_filters = {stream.name: DuplicateFilter(**self.DEDUP) for stream in self.pool.streams}
+
+    def get_detector_options(self) -> dict:
+        with open(self.DETECTOR_CONFIG_PATH, 'r') as config_file:
+            config = json.load(config_file)['motion_detector']
+
+        options = dict(self.DETECTOR_OPTIONS)
+        options.update({key: config[key] for key in self.DETECTOR_CONFIG_KEYS if key in config})
+        return options
+
+    # Cameras can either be listed under CAMERAS in env.json, each with their own detection zone config,
+    # or a single camera can be set at the top level.
+    def get_sources(self, env: dict) -> list:
+        cameras = env.get('CAMERAS', [env])
+        sources = []
+        for i, camera in enumerate(cameras):
+            with open(camera.get('CONFIG_PATH', self.CONFIG_PATH), 'r') as config_file:
+                config = json.load(config_file)
+
+            sources.append({
+                'name': camera.get('NAME', f'camera_{i}'),
+                'src': f"rtsp://{camera['USER']}:{camera['PASS']}@{camera['RTSP_URL']}",
+                'config': config,
+            })
+
+        return sources
+
+    # The pipeline's stages don't check for stale settings so cameras that need them are left out up front
+    def current_sources(self, env: dict) -> list:
+        sources = []
+        for source in self.get_sources(env):
+            if self.settings_stale(source['config']):
+                logging.warning(f"Not collecting from {source['name']}. The camera hasn't moved recently.")
+            else:
+                sources.append(source)
+
+        return sources
+
+    def settings_stale(self, config: dict) -> bool:
+        last_updated = datetime.datetime.strptime(config['last_updated'], '%Y-%m-%d %H:%M:%S')
         now = datetime.datetime.now()
         update_freq = datetime.timedelta(days=self.CAMERA_POS_UPDATE_FREQ)
         
         return (now - last_updated) > update_freq
 
-    def get_img_filename(self) -> str:
-        return Path(self.TEMP_PATH).joinpath(str(time.time()) + '_capture.jpg')
+    def get_img_filename(self, stream: CameraStream, timestamp=None) -> str:
+        timestamp = timestamp if timestamp is not None else time.time()
+        return f'{timestamp}_{stream.name}_capture.jpg'
 
-    def upload_img(self, frame):
-        if self.settings_stale():
-            logging.warning("Skipping upload. The camera hasn't moved recently.")
+    @timed('collector.upload_event')
+    def upload_event(self, stream: CameraStream, event: MotionEvent):
+        if self.settings_stale(stream.config):
+            logging.warning(f"Skipping upload from {stream.name}. The camera hasn't moved recently.")
             return
 
-        if self.last_upload_time is not None:
-            now = datetime.datetime.now()
-            diff = now - self.last_upload_time
-
-            if diff.total_seconds < self.UPLOAD_FREQUENCY:
-                return
+        for (_, timestamp, frame) in event.keyframes():
+            self.upload_img(stream, frame, timestamp)
 
-        self.last_upload_time = datetime.datetime.now()
-        img_path = self.save_image(frame)
-        try:
-            self.drive.upload_file(img_path)
-        except Exception as e:
-            # TODO: Create custom exception for capacity errors and log
-            logging.error(e)
-        finally:
-            os.remove(img_path)
+    def upload_img(self, stream: CameraStream, frame, timestamp=None):
+        # A cat sitting in the doorway would otherwise have the same picture uploaded for every event it sets off
+        if self.duplicate_filters[stream.name].is_duplicate(stream.detector.crop_frame(frame)):
+            stats.count('collector', 'duplicates_skipped')
+            return
 
-    def save_image(self, frame) -> str:
-        filename = self.get_img_filename()
-        cv2.imwrite(filename=filename, img=frame)
-        return filename
+        # The frame is encoded once and the bytes go straight to the uploader, nothing is written to disk.
+        # Neither step happens on this thread so detection carries straight on.
+        name = self.get_img_filename(stream, timestamp)
+        encoded = self.encode_image(frame)
+        encoded.add_done_callback(lambda encoded: self.queue_upload(encoded, name))
 
-    def run(self):
-        if not self.cam.frame_ready:
-            # Warm up the camera stream
-            time.sleep(1)
-            self.run()
+    def queue_upload(self, encoded: Future, name):
+        if encoded.cancelled():
+            return
+        if encoded.exception() is not None:
+            logging.error(f'Unable to encode {name}: {encoded.exception()}')
             return
 
-        frame: np.ndarray = None
-        processed_cnt = 0
-        while True:
-            frame = self.cam.get_frame()
+        self.uploader.submit(encoded.result(), name)
 
-            if processed_cnt == 0 or processed_cnt % self.bg_reset_frames == 0:
-                self.detector.set_bg_frame(frame)
-                processed_cnt += 1
-                continue
+    # Returns a Future for the JPEG bytes
+    def encode_image(self, frame) -> Future:
+        return self.encoder.encode(frame)
 
-            self.detector.set_compare_frame(frame)
-            if self.detector.movement_detected():
-                self.upload_img(frame)
+    def run(self):
+        if self.pipeline is not None:
+            self.run_pipeline()
+            return
 
-            processed_cnt += 1
+        self.uploader.start()
+        self.pool.start()
+        self.stats_writer.start()
+        try:
+            while True:
+                time.sleep(self.STATS_FREQUENCY)
+                for name, stream_stats in self.pool.stats().items():
+                    logging.info(
+                        f"{name}: {stream_stats['fps']} fps (sampling at {stream_stats['sample_fps']}), "
+                        f"{stream_stats['processed']} processed, {stream_stats['dropped']} dropped"
+                    )
+
+                upload_stats = self.uploader.stats()
+                logging.info(
+                    f"uploader: {upload_stats['queued']} queued, {upload_stats['uploaded']} uploaded, "
+                    f"{upload_stats['failed']} failed, {upload_stats['dropped']} dropped, "
+                    f"{upload_stats['uploads_per_min']} uploads/min, {upload_stats['bytes_per_s']} B/s"
+                )
+        finally:
+            self.shutdown()
+
+    # Events still in progress are uploaded, or left in the spool for next time if we don't get that far
+    def shutdown(self):
+        self.pool.shutdown()
+        self.encoder.shutdown() # Waits for the last event's frames to be encoded and handed to the uploader
+        self.uploader.stop()
+        self.stats_writer.stop()
+
+    def run_pipeline(self):
+        self.pipeline.start()
+        self.stats_writer.start()
+        try:
+            while True:
+                time.sleep(self.STATS_FREQUENCY)
+                down = [name for name, alive in self.pipeline.alive().items() if not alive]
+                if down:
+                    logging.warning(f"Pipeline stages down: {', '.join(down)}")
+        finally:
+            self.pipeline.stop()
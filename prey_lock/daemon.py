@@ -1,9 +1,14 @@
+import argparse
 import logging
 from collector.collector import Collector
 
 def main():
-    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO, filename='./logs/collector.txt')
-    collector = Collector()
+    parser = argparse.ArgumentParser(description='Collect training images from the cameras')
+    parser.add_argument('--pipeline', action='store_true', help='Run each stage in its own process')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO, filename=Collector.LOG_PATH)
+    collector = Collector(pipeline=args.pipeline)
     collector.run()
 
 if __name__ == "__main__":
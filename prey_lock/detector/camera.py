@@ -1,39 +1,137 @@
-from tkinter import *
-from tkinter import ttk
-
 import cv2
 import threading
 import time
 import sys
 
+from detector.frame_source import open_source
+from metrics.stats import stats
 
 class Camera():
     FPS = 30
     FPS_MS = int((1 / FPS) * 1000)
+    RING_SIZE = 4 # Number of frame buffers the capture thread cycles through
 
-    def __init__(self, src):
-        self.capture = cv2.VideoCapture(src)
+    # decode_every controls how many grabbed frames go by for each one that's actually decoded. Every frame is
+    # still grabbed to keep the stream drained, but decoding is the expensive part. Set it to 0 to only decode
+    # frames when a consumer calls request_decode().
+    # src can be anything cv2.VideoCapture takes, a video file, a directory of images or a frame source object.
+    # Frames are grabbed at fps, or as fast as the source allows if fps is 0.
+    def __init__(self, src, ring_size=RING_SIZE, decode_every=1, fps=FPS):
+        self.capture = src if hasattr(src, 'grab') else open_source(src)
         self.capture.set(cv2.CAP_PROP_BUFFERSIZE, 2)
 
+        # Files and image directories run out of frames, live streams just have hiccups
+        self.live = getattr(self.capture, 'live', True)
+        self.ended = False
+        self.fps = fps
+
         self.frame_ready = False
         self.frame = None
         self.previous_frame = None
 
+        # Frames are read into a small ring of reusable buffers. Each slot remembers the sequence number
+        # and capture time of the frame it holds so consumers can tell whether a frame is new.
+        # Note that a slot gets overwritten ring_size frames later, so copy a frame if you need to hold onto it.
+        self.ring = [None] * ring_size
+        self.ring_seqs = [0] * ring_size
+        self.ring_times = [0.0] * ring_size
+        self.seq = 0
+        self.frame_time = None
+        self.frame_cond = threading.Condition()
+
+        self.decode_every = decode_every
+        self.decode_seconds = 0.0 # How long the last frame took to decode, part of what detecting on it costs
+        self.grab_cnt = 0
+        self.decode_requested = threading.Event()
+
+        # Callables that get called with (seq, timestamp, frame) from the capture thread for every new frame.
+        # They should hand the frame off quickly since they hold up capture.
+        self.listeners = []
+        # Callables that get called with no arguments from the capture thread once a file source runs out
+        self.end_listeners = []
+
         # Start frame retrieval thread
         self.thread = threading.Thread(target=self.update, args=())
         self.thread.daemon = True
         self.thread.start()
 
     def update(self):
-        while True:
+        next_grab = time.time()
+        while not self.ended:
             if self.capture.isOpened():
-                (ret, raw_frame) = self.capture.read()
-                self.frame = raw_frame
-                
-            if not self.frame_ready:
-                self.frame_ready = True
+                self.grab_frame()
+
+            if self.fps:
+                next_grab += 1 / self.fps
+                time.sleep(max(0, next_grab - time.time()))
+
+    def grab_frame(self):
+        with stats.time('camera.grab'):
+            grabbed = self.capture.grab()
+
+        if not grabbed:
+            if not self.live:
+                self.end_stream()
+            return
+
+        self.grab_cnt += 1
+        stats.count('camera', 'frames_in')
+        if not self.decode_due():
+            stats.count('camera', 'skipped')
+            return
+
+        self.decode_requested.clear()
+        slot = self.seq % len(self.ring)
+        with stats.time('camera.decode'):
+            start = time.perf_counter()
+            (ret, raw_frame) = self.capture.retrieve(self.ring[slot])
+            self.decode_seconds = time.perf_counter() - start
+
+        if ret:
+            self.publish_frame(slot, raw_frame)
+        else:
+            stats.count('camera', 'dropped')
 
-            time.sleep(1 / Camera.FPS)
+    def decode_due(self) -> bool:
+        if self.decode_requested.is_set():
+            return True
+
+        return self.decode_every > 0 and self.grab_cnt % self.decode_every == 0
+
+    # Ask the capture thread to decode the next grabbed frame regardless of decode_every.
+    def request_decode(self):
+        self.decode_requested.set()
+
+    def publish_frame(self, slot, frame):
+        with self.frame_cond:
+            # retrieve() reallocates if the buffer doesn't match the stream's frame size so always keep what it returns
+            self.ring[slot] = frame
+            self.seq += 1
+            self.frame_time = time.time()
+            self.ring_seqs[slot] = self.seq
+            self.ring_times[slot] = self.frame_time
+
+            self.previous_frame = self.frame
+            self.frame = frame
+            self.frame_ready = True
+            self.frame_cond.notify_all()
+
+        for listener in self.listeners:
+            listener(self.ring_seqs[slot], self.ring_times[slot], frame)
+
+    def end_stream(self):
+        with self.frame_cond:
+            self.ended = True
+            self.frame_cond.notify_all()
+
+        for listener in self.end_listeners:
+            listener()
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def add_end_listener(self, listener):
+        self.end_listeners.append(listener)
 
     def get_frame(self):
         if not self.frame_ready:
@@ -41,6 +139,18 @@ class Camera():
 
         return self.frame
 
+    # Block until a frame newer than after_seq has been captured. Returns (seq, timestamp, frame), or None
+    # if no new frame arrived within timeout seconds or the source has run out of frames.
+    # Pass the returned seq back in to get the following frame.
+    def wait_for_frame(self, after_seq=0, timeout=None):
+        with self.frame_cond:
+            self.frame_cond.wait_for(lambda: self.seq > after_seq or self.ended, timeout)
+            if self.seq <= after_seq:
+                return None
+
+            slot = (self.seq - 1) % len(self.ring)
+            return (self.ring_seqs[slot], self.ring_times[slot], self.ring[slot])
+
     def clean_up(self):
         cv2.destroyAllWindows()
         sys.exit()
@@ -0,0 +1,250 @@
+"""
+Run motion detection for several camera streams in one process using a shared set of worker threads.
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from detector.camera import Camera
+from detector.motion_detector import MotionDetector
+from detector.clip_recorder import ClipRecorder
+from detector.motion_events import EventSegmenter
+from detector.sampling import AdaptiveSampler
+from metrics.stats import stats
+
+
+class CameraStream:
+    BG_RESET_TIME = 1 # in seconds
+    FPS_WINDOW = 5 # in seconds
+
+    # detector_options are passed through to MotionDetector, e.g. analysis_scale or bg_mode.
+    # sampling options are passed through to AdaptiveSampler, which then takes over from decode_every and
+    # lowers the decode rate while the stream is idle. Without them every decode_every-th frame is checked.
+    # events options are passed through to EventSegmenter, which groups the stream's motion into events.
+    # clips options are passed through to ClipRecorder, which records video of the motion with some pre-roll.
+    def __init__(
+        self,
+        name: str,
+        src,
+        config: dict,
+        decode_every=1,
+        detector_options=None,
+        sampling=None,
+        events=None,
+        clips=None
+    ) -> None:
+        self.name = name
+        self.config = config
+        self.cam = Camera(src, decode_every=decode_every)
+        self.detector = MotionDetector(config['sensitivity'], **(detector_options or {}))
+        self.detector.set_detection_zone(config['top_left'], config['width'], config['height'])
+
+        self.sampler = None
+        if sampling is not None:
+            self.sampler = AdaptiveSampler(Camera.FPS, **sampling)
+            self.cam.decode_every = self.sampler.decode_every()
+
+        self.set_bg_reset_frames()
+        self.segmenter = EventSegmenter(**events) if events is not None else None
+        # Frames and the flush at the end of the stream are handled on different worker threads
+        self.segmenter_lock = threading.Lock()
+
+        # The recorder sees every decoded frame, not just the ones that make it through detection
+        self.recorder = None
+        if clips is not None:
+            self.recorder = ClipRecorder(name, **clips)
+            self.cam.add_listener(self.recorder.push)
+
+        # Only one frame per stream is ever in the worker pool. Frames that arrive while it's busy are dropped
+        # so a slow stream can't starve the others or build up a backlog.
+        self.busy = False
+        self.processed_cnt = 0
+        self.frames_in = 0
+        self.dropped = 0
+        self.fps = 0.0
+        self.window_start = time.time()
+        self.window_cnt = 0
+
+    def set_bg_reset_frames(self):
+        decode_every = self.cam.decode_every
+        decoded_fps = Camera.FPS / decode_every if decode_every > 0 else Camera.FPS
+        self.bg_reset_frames = max(1, round(self.BG_RESET_TIME * decoded_fps))
+
+    def detect(self, frame: np.ndarray) -> bool:
+        start = time.perf_counter()
+        motion_detected = self.check_frame(frame)
+        if motion_detected and self.recorder is not None:
+            self.recorder.motion()
+        if self.sampler is not None:
+            # Frames are only decoded to be checked, so decoding counts against the CPU budget too
+            self.adapt(motion_detected, time.perf_counter() - start + self.cam.decode_seconds)
+
+        return motion_detected
+
+    # Frames arrive at whatever rate the camera is decoding at, so the sampling rate is changed at the source
+    # and frames that aren't going to be checked are never decoded
+    def adapt(self, motion_detected, detect_seconds):
+        self.sampler.record(motion_detected, detect_seconds)
+        decode_every = self.sampler.decode_every()
+        if decode_every != self.cam.decode_every:
+            self.cam.decode_every = decode_every
+            self.set_bg_reset_frames()
+
+    def check_frame(self, frame: np.ndarray) -> bool:
+        if self.detector.uses_running_bg():
+            # The running background updates itself with every frame so there's nothing to reset
+            self.detector.set_compare_frame(frame)
+            motion_detected = self.detector.movement_detected()
+        elif self.processed_cnt % self.bg_reset_frames == 0:
+            self.detector.set_bg_frame(frame)
+            motion_detected = False
+        else:
+            self.detector.set_compare_frame(frame)
+            motion_detected = self.detector.movement_detected()
+
+        self.processed_cnt += 1
+        self.update_fps()
+
+        return motion_detected
+
+    def update_fps(self):
+        self.window_cnt += 1
+        elapsed = time.time() - self.window_start
+        if elapsed >= self.FPS_WINDOW:
+            self.fps = self.window_cnt / elapsed
+            self.window_start = time.time()
+            self.window_cnt = 0
+
+    def stats(self) -> dict:
+        return {
+            'fps': round(self.fps, 2),
+            'frames_in': self.frames_in,
+            'processed': self.processed_cnt,
+            'dropped': self.dropped,
+            'sample_fps': round(Camera.FPS / self.cam.decode_every, 2) if self.cam.decode_every > 0 else 0.0,
+        }
+
+
+class CameraPool:
+    MAX_WORKERS = 2
+
+    # sources is a list of dicts with a name, a src that cv2.VideoCapture can open and the stream's detection
+    # zone config. on_motion gets called from a worker thread with (stream, frame) when motion is detected.
+    # With on_event set each stream segments its motion into events and on_event gets called with
+    # (stream, MotionEvent) when one finishes. Either callback can be None.
+    def __init__(
+        self,
+        sources: list,
+        on_motion,
+        max_workers=MAX_WORKERS,
+        decode_every=1,
+        detector_options=None,
+        sampling=None,
+        on_event=None,
+        events=None,
+        clips=None
+    ) -> None:
+        self.on_motion = on_motion
+        self.on_event = on_event
+        self.stopped = False
+        self.workers = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='camera_pool')
+        self.lock = threading.Lock()
+        self.streams: list[CameraStream] = []
+
+        for source in sources:
+            stream = CameraStream(
+                source['name'],
+                source['src'],
+                source['config'],
+                decode_every,
+                detector_options,
+                sampling,
+                (events or {}) if on_event is not None else None,
+                clips
+            )
+            self.streams.append(stream)
+
+    def start(self):
+        for stream in self.streams:
+            def listener(seq, timestamp, frame, self=self, stream=stream):
+                return self.dispatch(stream, frame)
+
+            stream.cam.add_listener(listener)
+            stream.cam.add_end_listener(lambda self=self, stream=stream: self.dispatch_end(stream))
+
+    def dispatch(self, stream: CameraStream, frame: np.ndarray):
+        with self.lock:
+            stream.frames_in += 1
+            if stream.busy:
+                stream.dropped += 1
+                stats.count(f'pool.{stream.name}', 'dropped')
+                return
+
+            stream.busy = True
+
+        stats.count(f'pool.{stream.name}', 'frames_in')
+
+        # The frame is one of the camera's ring buffers and gets decoded over once the ring comes back round to
+        # it. With more cameras than workers a frame can wait in the pool long enough for that to happen, so the
+        # worker gets its own copy.
+        frame = frame.copy()
+        with self.lock:
+            if self.stopped:
+                stream.busy = False
+                return
+
+            self.workers.submit(self.process_frame, stream, frame)
+
+    def process_frame(self, stream: CameraStream, frame: np.ndarray):
+        try:
+            motion_detected = stream.detect(frame)
+            if motion_detected and self.on_motion is not None:
+                self.on_motion(stream, frame)
+
+            if stream.segmenter is not None:
+                with stream.segmenter_lock:
+                    event = stream.segmenter.update(frame, motion_detected, stream.detector.last_percent_moved)
+                if event is not None:
+                    self.on_event(stream, event)
+        except Exception as e:
+            logging.exception(f'Error processing frame from camera {stream.name}: {e}')
+        finally:
+            with self.lock:
+                stream.busy = False
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {stream.name: stream.stats() for stream in self.streams}
+
+    # A file source has run out, so whatever event it was in the middle of is over
+    def dispatch_end(self, stream: CameraStream):
+        with self.lock:
+            if not self.stopped:
+                self.workers.submit(self.finish_event, stream)
+
+    def finish_event(self, stream: CameraStream):
+        if stream.segmenter is None:
+            return
+
+        with stream.segmenter_lock:
+            event = stream.segmenter.finish()
+        if event is not None:
+            try:
+                self.on_event(stream, event)
+            except Exception as e:
+                logging.exception(f'Error handling the last event from camera {stream.name}: {e}')
+
+    # Frames being processed are finished off and events still in progress are passed to on_event
+    def shutdown(self):
+        with self.lock:
+            self.stopped = True
+
+        self.workers.shutdown(wait=True)
+        for stream in self.streams:
+            self.finish_event(stream)
+            if stream.recorder is not None:
+                stream.recorder.stop()
@@ -0,0 +1,127 @@
+"""
+Rolling store of captured images.
+
+The folder is listed once when the store is created and kept in an in-memory index after that, so saving a
+capture never has to look at the directory. When the store goes over its file count or byte budget the oldest
+captures are deleted to make room, so the newest ones are always kept.
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import datetime
+from pathlib import Path
+
+from detector.image_encoder import ImageEncoder
+
+
+class CaptureStore:
+    MAX_FILES = 100
+    MAX_BYTES = 50 * 1024 * 1024
+    EXTENSION = '.jpg'
+
+    # One store per folder per process so that everything saving into a folder shares the index and budget
+    stores = {}
+    stores_lock = threading.Lock()
+
+    def __init__(self, path, max_files=MAX_FILES, max_bytes=MAX_BYTES) -> None:
+        self.path = Path(path)
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        # File name -> size in bytes, oldest first
+        self.index = OrderedDict()
+        self.total_bytes = 0
+        self.last_name = None
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.load_index()
+
+    # Get the store for path, creating it on first use. The limits only apply when the store is created.
+    @classmethod
+    def shared(cls, path, max_files=MAX_FILES, max_bytes=MAX_BYTES) -> 'CaptureStore':
+        key = str(Path(path).resolve())
+        with cls.stores_lock:
+            store = cls.stores.get(key)
+            if store is None:
+                store = cls(path, max_files, max_bytes)
+                cls.stores[key] = store
+
+        return store
+
+    # Capture file names are timestamps so name order is capture order
+    def load_index(self):
+        files = sorted(
+            item for item in self.path.iterdir() if item.is_file() and item.suffix == self.EXTENSION
+        )
+        with self.lock:
+            for item in files:
+                size = item.stat().st_size
+                self.index[item.name] = size
+                self.total_bytes += size
+
+            self.evict()
+
+    # Path for a new capture. Names have microseconds in them and are bumped if the clock hasn't moved on,
+    # so two captures never share a name.
+    def new_path(self) -> Path:
+        with self.lock:
+            name = datetime.now().strftime('%Y%m%d%H%M%S%f') + 'capture' + self.EXTENSION
+            if self.last_name is not None and name <= self.last_name:
+                stamp = int(self.last_name[:20]) + 1
+                name = f'{stamp}capture{self.EXTENSION}'
+            self.last_name = name
+
+        return self.path.joinpath(name)
+
+    # Record a file that has been written into the folder and evict the oldest captures if that went over budget
+    def add(self, path, size=None):
+        path = Path(path)
+        if size is None:
+            size = path.stat().st_size
+
+        with self.lock:
+            self.total_bytes += size - self.index.pop(path.name, 0)
+            self.index[path.name] = size
+            self.evict()
+
+    # Encoding and writing happen on the encoder's threads. Returns a Future for the path, the capture is added
+    # to the index once it's been written.
+    def save(self, frame, encoder: ImageEncoder = None) -> Future:
+        encoder = encoder or ImageEncoder.shared()
+        future = encoder.write(frame, self.new_path())
+        future.add_done_callback(self.on_saved)
+
+        return future
+
+    def on_saved(self, future: Future):
+        if future.cancelled() or future.exception() is not None:
+            return
+
+        self.add(future.result())
+
+    # Must be called with lock held
+    def evict(self):
+        while self.index and (len(self.index) > self.max_files or self.total_bytes > self.max_bytes):
+            (name, size) = self.index.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                self.path.joinpath(name).unlink()
+            except FileNotFoundError:
+                pass # Already removed by someone else, it just wasn't in our index
+            except OSError as e:
+                logging.error(f'Unable to remove old capture {name}: {e}')
+
+    def count(self) -> int:
+        with self.lock:
+            return len(self.index)
+
+    def size(self) -> int:
+        with self.lock:
+            return self.total_bytes
+
+    def files(self) -> list:
+        with self.lock:
+            return [self.path.joinpath(name) for name in self.index]
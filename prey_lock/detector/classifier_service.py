@@ -0,0 +1,113 @@
+"""
+Run the cat classifier off the capture loop.
+
+Frames are handed over through a bounded queue and classified on worker threads. detectMultiScale releases the
+GIL so the workers run alongside capture and motion detection instead of stalling them. When frames come in faster
+than they can be classified the overflow policy decides which ones get dropped.
+"""
+
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+from detector.cat_classifier import CatClassifier
+from metrics.stats import stats
+
+
+class ClassifierService:
+    DROP_OLDEST = 'drop_oldest' # Make room by discarding the frame that has been waiting longest
+    DROP_NEWEST = 'drop_newest' # Refuse the incoming frame
+    KEEP_LATEST = 'keep_latest' # Discard everything waiting, only the most recent frame matters
+    MAX_QUEUE = 4
+    WORKERS = 1
+
+    # classifier_config is the "cat_classifier" section of config/detector.json
+    def __init__(self, workers=WORKERS, max_queue=MAX_QUEUE, overflow=DROP_OLDEST, classifier_config=None) -> None:
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.queue = deque()
+        self.queue_cond = threading.Condition()
+        self.running = True
+
+        # Each worker gets its own classifier for its frame state, the loaded cascades are shared between them
+        self.workers = []
+        for i in range(workers):
+            classifier = CatClassifier(classifier_config)
+            worker = threading.Thread(target=self.work, args=(classifier,), name=f'classifier_{i}')
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    # Queue a frame for classification and return a Future for the is_cat result. The future is cancelled if the
+    # frame gets dropped. callback, if given, is called with the result from the worker thread. The frame is
+    # copied since camera frames are reused buffers, so the caller can carry on with it straight away.
+    # regions limits the search to those parts of the frame, see CatClassifier.load_frame.
+    def submit(self, frame, callback=None, save=True, regions=None) -> Future:
+        future = Future()
+        if callback is not None:
+            def on_done(done: Future, callback=callback):
+                if not done.cancelled() and done.exception() is None:
+                    callback(done.result())
+
+            future.add_done_callback(on_done)
+
+        with self.queue_cond:
+            if not self.running or (self.overflow == self.DROP_NEWEST and len(self.queue) >= self.max_queue):
+                stats.count('classifier', 'dropped')
+                future.cancel()
+                return future
+
+            if self.overflow == self.KEEP_LATEST:
+                self.drop_oldest(len(self.queue))
+            elif len(self.queue) >= self.max_queue:
+                self.drop_oldest(len(self.queue) - self.max_queue + 1)
+
+            self.queue.append((future, frame.copy(), regions, save))
+            stats.count('classifier', 'queued')
+            self.queue_cond.notify()
+
+        return future
+
+    # Must be called with queue_cond held
+    def drop_oldest(self, count):
+        for _ in range(count):
+            (future, _, _, _) = self.queue.popleft()
+            future.cancel()
+            stats.count('classifier', 'dropped')
+
+    def work(self, classifier: CatClassifier):
+        while True:
+            with self.queue_cond:
+                self.queue_cond.wait_for(lambda: self.queue or not self.running)
+                if not self.queue:
+                    return
+
+                (future, frame, regions, save) = self.queue.popleft()
+
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                classifier.load_frame(frame, regions)
+                result = classifier.is_cat()
+                if save:
+                    classifier.save_img()
+                future.set_result(result)
+            except Exception as e:
+                logging.exception(f'Classification failed: {e}')
+                future.set_exception(e)
+
+    def pending(self) -> int:
+        with self.queue_cond:
+            return len(self.queue)
+
+    # Stop the workers once the queue has been worked through. Frames submitted after this are dropped.
+    def stop(self, wait=True):
+        with self.queue_cond:
+            self.running = False
+            self.queue_cond.notify_all()
+
+        if wait:
+            for worker in self.workers:
+                worker.join()
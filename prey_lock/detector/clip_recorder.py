@@ -0,0 +1,220 @@
+"""
+Record short video clips around motion, starting a few seconds before it was noticed.
+
+Every decoded frame is shrunk and handed to the recorder's thread, which keeps the last pre_roll seconds of them
+as JPEG bytes. When motion is reported the buffered frames are written out as the start of a clip and recording
+carries on until there's been no motion for post_roll seconds. The capture thread only ever resizes a frame and
+puts it on a queue, encoding and writing all happen on the recorder's thread.
+
+Memory is capped by max_buffer_bytes for the pre-roll plus max_pending shrunk frames waiting for the thread.
+Clips go into a ClipStore per camera that deletes the oldest once they're over max_disk_bytes.
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from detector.capture_store import CaptureStore
+from metrics.stats import stats
+
+
+class ClipStore(CaptureStore):
+    EXTENSION = '.avi'
+
+
+class ClipRecorder:
+    CLIP_PATH = './clips'
+    PRE_ROLL = 5.0 # Seconds kept from before motion was noticed
+    POST_ROLL = 5.0 # Seconds recorded after the last motion
+    MAX_DURATION = 120.0 # Longer clips are ended and a new one started if the motion carries on
+    FPS = 10 # Frame rate clips are written at. Frames are repeated or skipped to keep to real time.
+    SCALE = 0.5
+    QUALITY = 80 # JPEG quality of buffered frames
+    FOURCC = 'MJPG'
+    MAX_BUFFER_BYTES = 16 * 1024 * 1024
+    MAX_PENDING = 8
+    MAX_CLIPS = 50
+    MAX_DISK_BYTES = 500 * 1024 * 1024
+    POLL_TIMEOUT = 0.5
+
+    def __init__(
+        self,
+        name,
+        path=CLIP_PATH,
+        pre_roll=PRE_ROLL,
+        post_roll=POST_ROLL,
+        max_duration=MAX_DURATION,
+        fps=FPS,
+        scale=SCALE,
+        quality=QUALITY,
+        max_buffer_bytes=MAX_BUFFER_BYTES,
+        max_pending=MAX_PENDING,
+        max_clips=MAX_CLIPS,
+        max_disk_bytes=MAX_DISK_BYTES
+    ) -> None:
+        self.name = name
+        self.pre_roll = pre_roll
+        self.post_roll = post_roll
+        self.max_duration = max_duration
+        self.fps = fps
+        self.scale = scale
+        self.quality = quality
+        self.max_buffer_bytes = max_buffer_bytes
+
+        self.store = ClipStore.shared(Path(path).joinpath(name), max_clips, max_disk_bytes)
+        self.tmp_path = self.store.path.joinpath('tmp')
+        self.tmp_path.mkdir(exist_ok=True)
+        for partial in self.tmp_path.iterdir():
+            partial.unlink() # Left behind by a clip that was being written when we last stopped
+
+        self.inbox = queue.Queue(maxsize=max_pending)
+        self.motion_at = None # Time motion was last reported, set from the detection thread
+
+        # Only touched by the recorder's thread
+        self.buffer = [] # (timestamp, jpeg bytes), oldest first
+        self.buffer_bytes = 0
+        self.writer = None
+        self.clip_path = None
+        self.clip_start = None
+        self.clip_size = None
+        self.clip_ended_at = 0.0
+        self.written = 0
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, args=(), name=f'clip_recorder_{name}')
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Camera listener, called from the capture thread with every decoded frame. The shrunk frame is a copy
+    # so the camera can reuse its buffer. Frames are dropped rather than holding up capture if the queue is full.
+    def push(self, seq, timestamp, frame):
+        if self.scale != 1.0:
+            frame = cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        else:
+            frame = frame.copy()
+
+        try:
+            self.inbox.put_nowait((timestamp, frame))
+        except queue.Full:
+            stats.count(f'clips.{self.name}', 'dropped')
+
+    # Called whenever motion is detected. Starts a clip if one isn't being recorded, otherwise extends it.
+    def motion(self, timestamp=None):
+        self.motion_at = timestamp if timestamp is not None else time.time()
+
+    def run(self):
+        while self.running:
+            try:
+                (timestamp, frame) = self.inbox.get(timeout=self.POLL_TIMEOUT)
+            except queue.Empty:
+                # The camera may have stalled, don't leave a clip open forever waiting for frames
+                if self.writer is not None and time.time() - self.motion_at >= self.post_roll:
+                    self.end_clip()
+                continue
+
+            try:
+                self.handle_frame(timestamp, frame)
+            except Exception as e:
+                logging.exception(f'Error recording clip for {self.name}: {e}')
+                self.abandon_clip()
+
+        if self.writer is not None:
+            self.end_clip()
+
+    def handle_frame(self, timestamp, frame):
+        motion_at = self.motion_at
+        if self.writer is None:
+            if motion_at is not None and motion_at > self.clip_ended_at:
+                self.start_clip(timestamp, frame)
+            else:
+                self.buffer_frame(timestamp, frame)
+            return
+
+        self.write_frame(timestamp, frame)
+        if timestamp - motion_at >= self.post_roll or timestamp - self.clip_start >= self.max_duration:
+            self.end_clip(timestamp)
+
+    # Keep the last pre_roll seconds, or as many of them as fit in max_buffer_bytes
+    def buffer_frame(self, timestamp, frame):
+        (ok, encoded) = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        if not ok:
+            return
+
+        data = encoded.tobytes()
+        self.buffer.append((timestamp, data))
+        self.buffer_bytes += len(data)
+
+        drop = 0
+        while drop < len(self.buffer) and (
+            timestamp - self.buffer[drop][0] > self.pre_roll or self.buffer_bytes > self.max_buffer_bytes
+        ):
+            self.buffer_bytes -= len(self.buffer[drop][1])
+            drop += 1
+        del self.buffer[:drop]
+
+    def start_clip(self, timestamp, frame):
+        (height, width) = frame.shape[:2]
+        self.clip_size = (width, height)
+        self.clip_path = self.store.new_path()
+        tmp_path = self.tmp_path.joinpath(self.clip_path.name)
+        self.writer = cv2.VideoWriter(
+            str(tmp_path), cv2.VideoWriter_fourcc(*self.FOURCC), self.fps, self.clip_size
+        )
+        if not self.writer.isOpened():
+            self.writer = None
+            raise IOError(f'Unable to open {tmp_path} for writing')
+
+        self.clip_start = self.buffer[0][0] if self.buffer else timestamp
+        self.written = 0
+        for (buffered_at, data) in self.buffer:
+            self.write_frame(buffered_at, cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR))
+
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.write_frame(timestamp, frame)
+        stats.count(f'clips.{self.name}', 'started')
+
+    # Frames come in at whatever rate the camera is decoding, which changes with the sampling rate, so each
+    # one is written as many times as it takes for the clip to catch up with its timestamp
+    def write_frame(self, timestamp, frame):
+        (width, height) = self.clip_size
+        if frame.shape[:2] != (height, width):
+            frame = cv2.resize(frame, self.clip_size, interpolation=cv2.INTER_AREA)
+
+        target = int((timestamp - self.clip_start) * self.fps) + 1
+        while self.written < target:
+            self.writer.write(frame)
+            self.written += 1
+
+    def end_clip(self, timestamp=None):
+        self.writer.release()
+        self.writer = None
+        self.clip_ended_at = timestamp if timestamp is not None else time.time()
+
+        tmp_path = self.tmp_path.joinpath(self.clip_path.name)
+        os.replace(tmp_path, self.clip_path)
+        self.store.add(self.clip_path)
+        stats.count(f'clips.{self.name}', 'written')
+        logging.info(f'Recorded {self.written / self.fps:.1f}s clip {self.clip_path}')
+
+    # Drop the clip being written after an error. Motion from before now won't start another one, so a writer
+    # that can't be opened isn't retried on every frame.
+    def abandon_clip(self):
+        self.clip_ended_at = time.time()
+        if self.writer is None:
+            return
+
+        self.writer.release()
+        self.writer = None
+        self.tmp_path.joinpath(self.clip_path.name).unlink(missing_ok=True)
+
+    # Finishes the clip being recorded, if any
+    def stop(self):
+        self.running = False
+        self.thread.join()
@@ -0,0 +1,47 @@
+"""
+Spot frames that look practically the same as one seen recently, so they don't get uploaded over and over.
+
+Frames are compared by difference hash (dHash): the frame is shrunk to a 9x8 grayscale thumbnail and each bit of
+the 64 bit hash says whether a pixel is brighter than its right hand neighbour. Small changes in noise, exposure
+or compression only flip a few bits, so two frames within a few bits of each other are treated as the same.
+"""
+
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+HASH_SIZE = 8
+
+
+def dhash(frame, hash_size=HASH_SIZE) -> int:
+    gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    thumb = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (thumb[:, 1:] > thumb[:, :-1]).flatten()
+
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+class DuplicateFilter:
+    MAX_DISTANCE = 6 # Hashes this many bits apart or fewer are the same picture
+    CAPACITY = 64 # Recent hashes remembered
+
+    def __init__(self, max_distance=MAX_DISTANCE, capacity=CAPACITY) -> None:
+        self.max_distance = max_distance
+        self.capacity = capacity
+        self.recent = OrderedDict() # hash -> None, least recently seen first
+
+    # True if the frame is a near duplicate of a recent one. Either way the frame counts as seen: a match is
+    # refreshed in the LRU and a new hash is added to it.
+    def is_duplicate(self, frame) -> bool:
+        frame_hash = dhash(frame)
+        for recent_hash in self.recent:
+            if (frame_hash ^ recent_hash).bit_count() <= self.max_distance:
+                self.recent.move_to_end(recent_hash)
+                return True
+
+        self.recent[frame_hash] = None
+        if len(self.recent) > self.capacity:
+            self.recent.popitem(last=False)
+
+        return False
@@ -0,0 +1,106 @@
+"""
+Frame sources for Camera besides live streams: video files and directories of images.
+
+They have the same grab/retrieve/read interface as cv2.VideoCapture so they can be dropped in wherever a
+capture is expected. Unlike a live stream they run out of frames, which is what the live flag is for.
+"""
+
+import cv2
+from pathlib import Path
+
+
+class VideoFileSource:
+    live = False
+
+    def __init__(self, path) -> None:
+        self.capture = cv2.VideoCapture(str(path))
+
+    def isOpened(self) -> bool:
+        return self.capture.isOpened()
+
+    def grab(self) -> bool:
+        return self.capture.grab()
+
+    def retrieve(self, image=None):
+        return self.capture.retrieve(image)
+
+    def read(self, image=None):
+        return self.capture.read(image)
+
+    def get(self, prop_id):
+        return self.capture.get(prop_id)
+
+    def set(self, prop_id, value) -> bool:
+        return self.capture.set(prop_id, value)
+
+    def release(self):
+        self.capture.release()
+
+
+class ImageDirSource:
+    live = False
+    EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+    # Images are played back in filename order, which is capture order for the timestamped names we save
+    def __init__(self, path) -> None:
+        self.files = sorted(
+            item for item in Path(path).iterdir() if item.is_file() and item.suffix.lower() in self.EXTENSIONS
+        )
+        self.pos = -1
+        self.frame_size = None
+
+    def isOpened(self) -> bool:
+        return self.pos < len(self.files)
+
+    # Grabbing just moves to the next file, nothing gets decoded until retrieve
+    def grab(self) -> bool:
+        self.pos += 1
+        return self.pos < len(self.files)
+
+    def retrieve(self, image=None):
+        if self.pos < 0 or self.pos >= len(self.files):
+            return (False, None)
+
+        frame = cv2.imread(str(self.files[self.pos]))
+        if frame is None:
+            return (False, None)
+
+        self.frame_size = (frame.shape[1], frame.shape[0])
+        return (True, frame)
+
+    def read(self, image=None):
+        if not self.grab():
+            return (False, None)
+
+        return self.retrieve(image)
+
+    def get(self, prop_id):
+        if prop_id == cv2.CAP_PROP_FRAME_COUNT:
+            return len(self.files)
+        if prop_id == cv2.CAP_PROP_POS_FRAMES:
+            return self.pos + 1
+        if self.frame_size is not None and prop_id == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.frame_size[0]
+        if self.frame_size is not None and prop_id == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.frame_size[1]
+
+        return 0
+
+    def set(self, prop_id, value) -> bool:
+        return False
+
+    def release(self):
+        self.pos = len(self.files)
+
+
+# Open src as a frame source. Directories and video files get a source that stops at the end,
+# anything else (RTSP urls, device indexes) is handed to cv2.VideoCapture as a live stream.
+def open_source(src):
+    if isinstance(src, (str, Path)):
+        path = Path(src)
+        if path.is_dir():
+            return ImageDirSource(path)
+        if path.is_file():
+            return VideoFileSource(path)
+
+    return cv2.VideoCapture(src)
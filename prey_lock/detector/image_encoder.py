@@ -0,0 +1,101 @@
+"""
+Encode and write JPEGs off the calling thread.
+
+Encoding a full size frame takes tens of milliseconds, which is long enough to hold up the capture loop or the
+UI. The encoder copies the frame once and does the encode and the write on a small thread pool; cv2.imencode
+releases the GIL so the pool runs alongside everything else. Files are written atomically so anything reading
+the folder never sees half an image.
+"""
+
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+import cv2
+
+from metrics.stats import stats, timed
+
+
+class ImageEncoder:
+    QUALITY = 90
+    WORKERS = 2
+    MAX_PENDING = 4 # Frames being encoded or waiting to be, beyond this submitting applies backpressure
+
+    BLOCK = 'block' # Wait for a slot to free up
+    DROP = 'drop' # Return a cancelled future straight away
+
+    shared_encoder = None
+    shared_lock = threading.Lock()
+
+    def __init__(self, workers=WORKERS, quality=QUALITY, max_pending=MAX_PENDING, overflow=BLOCK) -> None:
+        self.quality = quality
+        self.overflow = overflow
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='encoder')
+
+    # The encoder used by every capture path, created on first use. The options only apply when it's created.
+    @classmethod
+    def shared(cls, workers=WORKERS, quality=QUALITY, max_pending=MAX_PENDING, overflow=BLOCK) -> 'ImageEncoder':
+        with cls.shared_lock:
+            if cls.shared_encoder is None:
+                cls.shared_encoder = cls(workers, quality, max_pending, overflow)
+
+        return cls.shared_encoder
+
+    # Returns a Future for the JPEG bytes
+    def encode(self, frame, quality=None) -> Future:
+        return self.submit(self.encode_frame, frame, quality)
+
+    # Returns a Future for the path once the file is in place
+    def write(self, frame, path, quality=None) -> Future:
+        return self.submit(self.write_frame, frame, quality, Path(path))
+
+    def submit(self, fn, frame, *args) -> Future:
+        if not self.slots.acquire(blocking=self.overflow == self.BLOCK):
+            stats.count('encoder', 'dropped')
+            future = Future()
+            future.cancel()
+            return future
+
+        # Camera frames are reused buffers so take our own copy before handing over
+        try:
+            future = self.executor.submit(fn, frame.copy(), *args)
+        except Exception:
+            self.slots.release()
+            raise
+
+        future.add_done_callback(lambda _: self.slots.release())
+        stats.count('encoder', 'queued')
+        return future
+
+    @timed('encoder.encode')
+    def encode_frame(self, frame, quality) -> bytes:
+        quality = quality if quality is not None else self.quality
+        (ok, encoded) = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if not ok:
+            raise ValueError('Unable to encode frame')
+
+        return encoded.tobytes()
+
+    @timed('encoder.write')
+    def write_frame(self, frame, quality, path: Path) -> Path:
+        data = self.encode_frame(frame, quality)
+        tmp_path = path.with_name(path.name + '.tmp')
+        try:
+            with open(tmp_path, 'wb') as out:
+                out.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.error(f'Unable to write {path}: {e}')
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        return path
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
@@ -2,39 +2,188 @@ import cv2
 import numpy as np
 import sys
 from detector.camera import Camera
+from metrics.stats import timed
 
 class MotionDetector():
-    def __init__(self, sensitivity):
+    ANALYSIS_SCALE = 1.0
+    BLUR_SIZE = 5
+    KERNEL_SIZE = 6
+    DIFF_THRESHOLD = 20 # How different a pixel has to be from the background (out of 255) to count as moved
+
+    # Background modes. A snapshot background is a single frame that the owner is expected to refresh
+    # every so often with set_bg_frame. A running background is an exponentially weighted average of
+    # every compare frame, so it keeps up with slow changes (lighting, shadows) without any resets.
+    BG_SNAPSHOT = 'snapshot'
+    BG_RUNNING = 'running'
+    LEARNING_RATE = 0.05 # Weight of each new frame in the running background
+    REGION_MERGE_DISTANCE = 20 # Motion regions closer than this (in frame pixels) are merged into one
+    REGION_PADDING = 0.2 # Fraction of a region's size added on each side so the whole cat ends up inside it
+
+    # analysis_scale shrinks frames before they're compared. Percent moved doesn't need every pixel so
+    # this is a cheap way to cut the cost of detection on high resolution cameras.
+    # With preallocate set, every stage writes into work buffers owned by the detector instead of allocating
+    # new arrays for each frame. The buffers are sized to the detection zone and only reallocated if it changes.
+    def __init__(
+        self,
+        sensitivity,
+        analysis_scale=ANALYSIS_SCALE,
+        bg_mode=BG_SNAPSHOT,
+        learning_rate=LEARNING_RATE,
+        preallocate=False
+    ):
         self.sensitivity = sensitivity
         self.debug = False
         self.bg_frame = None
         self.compare_frame = None
 
         self.compare_ready = False
-        self.kernel = np.ones((6, 6))
+        self.set_analysis_scale(analysis_scale)
+
+        self.bg_mode = bg_mode
+        self.learning_rate = learning_rate
+        self.bg_accumulator = None # float32 running average, only used with BG_RUNNING
+
+        # The detection zone is stored relative to the frame size and compiled into pixel slices the first
+        # time we see a frame of a given shape.
+        self.detection_zone = None
+        self.roi = None
+        self.roi_shape = None
+
+        self.preallocate = preallocate
+        self.buffers = {}
+        self.frame_shape = None # Shape of the last full size frame prepared, used to map regions back onto it
+        self.last_percent_moved = None
+
+    def set_analysis_scale(self, analysis_scale):
+        self.analysis_scale = analysis_scale
+
+        # Scale the blur and dilation along with the frame so they cover the same area of the scene
+        blur_size = max(1, round(self.BLUR_SIZE * analysis_scale))
+        if blur_size % 2 == 0:
+            blur_size += 1
+
+        self.blur_ksize = (blur_size, blur_size)
+        kernel_size = max(1, round(self.KERNEL_SIZE * analysis_scale))
+        self.kernel = np.ones((kernel_size, kernel_size), np.uint8)
+
+    def uses_running_bg(self) -> bool:
+        return self.bg_mode == self.BG_RUNNING
+
+    # Returns the named work buffer, or None when not preallocating so OpenCV allocates the output as usual
+    def buffer(self, name, shape, dtype=np.uint8):
+        if not self.preallocate:
+            return None
+
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype)
+            self.buffers[name] = buffer
+
+        return buffer
 
     def set_bg_frame(self, frame):
-        self.bg_frame = self.prepare_frame(frame) if frame is not None else frame
+        self.bg_frame = self.prepare_frame(frame, 'bg') if frame is not None else frame
+        if self.uses_running_bg():
+            self.reset_accumulator()
 
     def set_compare_frame(self, frame):
-        self.compare_frame = self.prepare_frame(frame) if frame is not None else frame
+        self.compare_frame = self.prepare_frame(frame, 'compare') if frame is not None else frame
+        if self.uses_running_bg() and self.compare_frame is not None:
+            self.update_running_bg()
+
+    def reset_accumulator(self):
+        self.bg_accumulator = self.bg_frame.astype(np.float32) if self.bg_frame is not None else None
+
+    # The compare frame is checked against the average of the frames before it, then folded into the average.
+    def update_running_bg(self):
+        if self.bg_accumulator is None or self.bg_accumulator.shape != self.compare_frame.shape:
+            self.bg_frame = self.compare_frame
+            self.reset_accumulator()
+            return
+
+        self.bg_frame = cv2.convertScaleAbs(self.bg_accumulator, dst=self.buffer('bg', self.bg_accumulator.shape))
+        cv2.accumulateWeighted(self.compare_frame, self.bg_accumulator, self.learning_rate)
+
+    # Only the part of the frame inside the detection zone is compared. Values are fractions of the frame size.
+    def set_detection_zone(self, rel_topleft, rel_width, rel_height):
+        detection_zone = (tuple(rel_topleft), rel_width, rel_height)
+        if detection_zone == self.detection_zone:
+            return
+
+        self.detection_zone = detection_zone
+        self.roi = None
+        self.roi_shape = None
+
+    def get_roi(self, frame_shape):
+        if self.detection_zone is None:
+            return None
+
+        if self.roi is None or self.roi_shape != frame_shape[:2]:
+            (rel_topleft, rel_width, rel_height) = self.detection_zone
+            x1 = round(rel_topleft[0] * frame_shape[1])
+            y1 = round(rel_topleft[1] * frame_shape[0])
+            x2 = round((rel_topleft[0] + rel_width) * frame_shape[1])
+            y2 = round((rel_topleft[1] + rel_height) * frame_shape[0])
+
+            self.roi = (slice(y1, y2), slice(x1, x2))
+            self.roi_shape = frame_shape[:2]
 
-    def prepare_frame(self, frame):
-        frame_bw = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        prepared_frame =  cv2.GaussianBlur(frame_bw, ksize=(5, 5), sigmaX=0)
+        return self.roi
+
+    def crop_frame(self, frame):
+        roi = self.get_roi(frame.shape)
+        if roi is None:
+            return frame
+
+        return frame[roi]
+
+    # Cropping happens first so none of the preprocessing is spent on pixels outside the detection zone
+    @timed('detector.prepare')
+    def prepare_frame(self, frame, buffer_name='prepared'):
+        self.frame_shape = frame.shape[:2]
+        frame = self.crop_frame(frame)
+        if frame.ndim == 2:
+            frame_bw = frame # Already grayscale, e.g. recorded footage passed to score_batch
+        else:
+            frame_bw = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self.buffer('gray', frame.shape[:2]))
+        if self.analysis_scale != 1.0:
+            height = max(1, round(frame_bw.shape[0] * self.analysis_scale))
+            width = max(1, round(frame_bw.shape[1] * self.analysis_scale))
+            frame_bw = cv2.resize(
+                frame_bw,
+                (width, height),
+                dst=self.buffer('scaled', (height, width)),
+                interpolation=cv2.INTER_AREA
+            )
+
+        prepared_frame =  cv2.GaussianBlur(
+            frame_bw,
+            ksize=self.blur_ksize,
+            sigmaX=0,
+            dst=self.buffer(buffer_name, frame_bw.shape)
+        )
 
         return prepared_frame
 
+    @timed('detector.threshold')
     def get_threshold(self):
         if self.bg_frame is None:
             return None
 
         try:
-            diff_frame = cv2.absdiff(self.bg_frame, self.compare_frame)
+            shape = self.compare_frame.shape
+            diff_frame = cv2.absdiff(self.bg_frame, self.compare_frame, dst=self.buffer('diff', shape))
             diff_frame = self.dilute(diff_frame)
 
-            # Only take different areas that are different enough (>20 / 255)
-            thresh_frame = cv2.threshold(diff_frame, thresh=20, maxval=255, type=cv2.THRESH_BINARY)[1]
+            # Only take different areas that are different enough. When preallocating this is done
+            # in place since the diluted frame isn't needed afterwards.
+            thresh_frame = cv2.threshold(
+                diff_frame,
+                thresh=self.DIFF_THRESHOLD,
+                maxval=255,
+                type=cv2.THRESH_BINARY,
+                dst=diff_frame if self.preallocate else None
+            )[1]
         except cv2.error as e:
             if self.debug:
                 print('Unable to compare frames of different dimensions')
@@ -44,9 +193,97 @@ class MotionDetector():
 
     # Dilute the image a bit to make differences more seeable; more suitable for contour detection
     def dilute(self, frame):
-        diluted_frame = cv2.dilate(frame, self.kernel, 1)
+        diluted_frame = cv2.dilate(frame, self.kernel, dst=self.buffer('diluted', frame.shape))
         return diluted_frame
 
+    # Score a whole stack of frames, for re-analysing recorded footage and tuning. frames is an (N, H, W)
+    # grayscale or (N, H, W, 3) BGR uint8 array. Returns the percent moved for each frame using the same
+    # detection zone, scale and background mode as this detector, without touching its state.
+    # With a snapshot background, frame 0 is the background for the whole stack unless bg_reset_frames is set,
+    # in which case the background is re-taken every bg_reset_frames frames like CameraStream does.
+    # Frames used as a background score 0.
+    def score_batch(self, frames, bg_reset_frames=None) -> np.ndarray:
+        # Each frame goes through every stage while it's still in cache, with all of the intermediate arrays
+        # reused from frame to frame. Running each stage over the whole stack at once is memory bound and
+        # measured slower than this.
+        scorer = MotionDetector(self.sensitivity, self.analysis_scale, self.bg_mode, self.learning_rate, True)
+        scorer.detection_zone = self.detection_zone
+
+        scores = np.zeros(len(frames))
+        bg_reset_frames = bg_reset_frames or len(frames)
+        for i, frame in enumerate(frames):
+            if not scorer.uses_running_bg() and i % bg_reset_frames == 0:
+                scorer.set_bg_frame(frame)
+                continue
+
+            scorer.set_compare_frame(frame)
+            scores[i] = scorer.percent_moved() or 0.0
+
+        return scores
+
+    # Bounding boxes (x, y, w, h) of the areas that moved, in the coordinates of the full size frame passed to
+    # set_compare_frame. Boxes close to each other are merged and all of them padded a bit so that a cat split
+    # into pieces by the threshold still ends up in a single box.
+    def motion_regions(self) -> list:
+        thresh_frame = self.get_threshold()
+        if thresh_frame is None:
+            return []
+
+        (frame_h, frame_w) = self.frame_shape
+        (offset_x, offset_y, crop_w, crop_h) = (0, 0, frame_w, frame_h)
+        roi = self.get_roi(self.frame_shape)
+        if roi is not None:
+            (rows, cols) = roi
+            (offset_x, offset_y) = (cols.start, rows.start)
+            (crop_w, crop_h) = (cols.stop - cols.start, rows.stop - rows.start)
+
+        scale_x = crop_w / thresh_frame.shape[1]
+        scale_y = crop_h / thresh_frame.shape[0]
+
+        contours = cv2.findContours(thresh_frame, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[0]
+        boxes = []
+        for contour in contours:
+            (x, y, w, h) = cv2.boundingRect(contour)
+            boxes.append((
+                offset_x + x * scale_x,
+                offset_y + y * scale_y,
+                offset_x + (x + w) * scale_x,
+                offset_y + (y + h) * scale_y
+            ))
+
+        regions = []
+        for (x1, y1, x2, y2) in self.merge_boxes(boxes):
+            pad_x = (x2 - x1) * self.REGION_PADDING
+            pad_y = (y2 - y1) * self.REGION_PADDING
+            x1 = max(0, int(x1 - pad_x))
+            y1 = max(0, int(y1 - pad_y))
+            x2 = min(frame_w, int(x2 + pad_x + 0.5))
+            y2 = min(frame_h, int(y2 + pad_y + 0.5))
+            regions.append((x1, y1, x2 - x1, y2 - y1))
+
+        return regions
+
+    # Merge (x1, y1, x2, y2) boxes that overlap or are within REGION_MERGE_DISTANCE of each other.
+    # There are only ever a handful of boxes per frame so the pairwise loop is fine.
+    def merge_boxes(self, boxes) -> list:
+        gap = self.REGION_MERGE_DISTANCE
+        merged = True
+        while merged and len(boxes) > 1:
+            merged = False
+            for i in range(len(boxes)):
+                for j in range(i + 1, len(boxes)):
+                    (ax1, ay1, ax2, ay2) = boxes[i]
+                    (bx1, by1, bx2, by2) = boxes[j]
+                    if ax1 - gap <= bx2 and bx1 - gap <= ax2 and ay1 - gap <= by2 and by1 - gap <= ay2:
+                        boxes[i] = (min(ax1, bx1), min(ay1, by1), max(ax2, bx2), max(ay2, by2))
+                        del boxes[j]
+                        merged = True
+                        break
+                if merged:
+                    break
+
+        return boxes
+
     def show_diff(self):
         thresh_frame = self.get_threshold()
         if thresh_frame is None:
@@ -57,13 +294,18 @@ class MotionDetector():
         if cv2.waitKey(Camera.FPS_MS) == 27:
             self.clean_up()
 
-    def movement_detected(self) -> bool:
+    def percent_moved(self):
         thresh_frame = self.get_threshold()
         if thresh_frame is None:
+            return None
+
+        self.last_percent_moved = cv2.countNonZero(thresh_frame) / thresh_frame.size
+        return self.last_percent_moved
+
+    def movement_detected(self) -> bool:
+        percent_moved = self.percent_moved()
+        if percent_moved is None:
             return False
-        
-        pixels_moved = thresh_frame[thresh_frame == 255].size
-        percent_moved = pixels_moved / thresh_frame.size
 
         if self.debug:
             if percent_moved > self.sensitivity:
@@ -0,0 +1,114 @@
+"""
+Group consecutive motion frames into events and keep only the best few frames of each.
+
+An event starts once motion has been seen in start_frames frames in a row and ends once there's been none for
+end_after seconds, so a single noisy frame doesn't start an event and a cat pausing for a moment doesn't end one.
+While the event runs each motion frame is scored on how sharp it is and how much of the zone moved, and the top_k
+best are held onto. Only those get saved or uploaded when the event ends.
+"""
+
+import heapq
+import itertools
+import time
+
+import cv2
+
+from metrics.stats import stats
+
+
+class MotionEvent:
+    def __init__(self, start) -> None:
+        self.start = start
+        self.end = start
+        self.motion_frames = 0
+        self.best = [] # Min heap of (score, tiebreak, timestamp, frame)
+
+    # Best frames first, as (score, timestamp, frame)
+    def keyframes(self) -> list:
+        return [(score, timestamp, frame) for (score, _, timestamp, frame) in sorted(self.best, reverse=True)]
+
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+class EventSegmenter:
+    START_FRAMES = 2 # Motion frames in a row before an event starts
+    END_AFTER = 2.0 # Seconds without motion before an event ends
+    MAX_DURATION = 60.0 # Longer events are split so a cat that settles down still gets frames out regularly
+    TOP_K = 3
+    SCORE_WIDTH = 320 # Frames are shrunk to this width before measuring sharpness
+    AREA_BIAS = 0.05 # Keeps a frame with only a little motion from scoring nothing however sharp it is
+
+    def __init__(
+        self,
+        start_frames=START_FRAMES,
+        end_after=END_AFTER,
+        max_duration=MAX_DURATION,
+        top_k=TOP_K
+    ) -> None:
+        self.start_frames = start_frames
+        self.end_after = end_after
+        self.max_duration = max_duration
+        self.top_k = top_k
+
+        self.event = None
+        self.motion_run = 0
+        self.last_motion = None
+        self.tiebreak = itertools.count()
+
+    # Sharpness (variance of the Laplacian) scaled by the fraction of the zone that moved
+    def score(self, frame, percent_moved) -> float:
+        gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if gray.shape[1] > self.SCORE_WIDTH:
+            height = max(1, round(gray.shape[0] * self.SCORE_WIDTH / gray.shape[1]))
+            gray = cv2.resize(gray, (self.SCORE_WIDTH, height), interpolation=cv2.INTER_AREA)
+
+        sharpness = cv2.Laplacian(gray, cv2.CV_64F).var()
+        return sharpness * (self.AREA_BIAS + (percent_moved or 0.0))
+
+    # Feed every processed frame in, motion or not. Returns the event that just finished, if any.
+    # Frames are only copied when they make it into an event's top_k.
+    def update(self, frame, motion_detected, percent_moved=None, timestamp=None):
+        now = timestamp if timestamp is not None else time.time()
+        finished = None
+
+        if self.event is not None:
+            quiet = not motion_detected and now - self.last_motion >= self.end_after
+            if quiet or now - self.event.start >= self.max_duration:
+                finished = self.finish()
+
+        if not motion_detected:
+            self.motion_run = 0
+            return finished
+
+        self.motion_run += 1
+        self.last_motion = now
+        if self.event is None:
+            if self.motion_run < self.start_frames:
+                return finished
+            self.event = MotionEvent(now)
+            stats.count('events', 'started')
+
+        self.event.end = now
+        self.event.motion_frames += 1
+        self.keep(frame, percent_moved, now)
+
+        return finished
+
+    def keep(self, frame, percent_moved, timestamp):
+        score = self.score(frame, percent_moved)
+        best = self.event.best
+        if len(best) < self.top_k:
+            heapq.heappush(best, (score, next(self.tiebreak), timestamp, frame.copy()))
+        elif score > best[0][0]:
+            heapq.heapreplace(best, (score, next(self.tiebreak), timestamp, frame.copy()))
+
+    # End the current event, e.g. on shutdown. Returns it, or None if there wasn't one.
+    def finish(self):
+        event = self.event
+        self.event = None
+        if event is not None:
+            stats.count('events', 'finished')
+            stats.count('events', 'keyframes', len(event.best))
+
+        return event
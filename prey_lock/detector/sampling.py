@@ -0,0 +1,60 @@
+"""
+Adaptive frame sampling for motion detection.
+
+A quiet doorway doesn't need checking thirty times a second. While nothing has moved for a while a stream is
+only sampled a couple of times a second, and as soon as motion shows up it goes back to the full rate. The rate
+is also capped so detection stays within a CPU budget however expensive the frames turn out to be.
+"""
+
+import time
+
+
+class AdaptiveSampler:
+    IDLE_FPS = 2.0
+    ACTIVE_FPS = 15.0
+    IDLE_AFTER = 10 # Seconds without motion before dropping to the idle rate
+    CPU_BUDGET = 0.5 # Fraction of one core detection on this stream may use
+    SMOOTHING = 0.2 # Weight of the latest detection time in the running average
+
+    def __init__(
+        self,
+        camera_fps,
+        active_fps=ACTIVE_FPS,
+        idle_fps=IDLE_FPS,
+        idle_after=IDLE_AFTER,
+        cpu_budget=CPU_BUDGET
+    ) -> None:
+        self.camera_fps = camera_fps
+        self.active_fps = min(active_fps, camera_fps)
+        self.idle_fps = min(idle_fps, self.active_fps)
+        self.idle_after = idle_after
+        self.cpu_budget = cpu_budget
+
+        self.last_motion = None
+        self.detect_cost = None # Running average of seconds spent decoding and detecting per frame
+
+    def record(self, motion_detected, detect_seconds, now=None):
+        now = now if now is not None else time.monotonic()
+        if motion_detected:
+            self.last_motion = now
+
+        if self.detect_cost is None:
+            self.detect_cost = detect_seconds
+        else:
+            self.detect_cost += self.SMOOTHING * (detect_seconds - self.detect_cost)
+
+    def idle(self, now=None) -> bool:
+        now = now if now is not None else time.monotonic()
+        return self.last_motion is None or now - self.last_motion >= self.idle_after
+
+    # Frames per second to run detection at. Motion always gets at least the idle rate, even over budget.
+    def target_fps(self, now=None) -> float:
+        fps = self.idle_fps if self.idle(now) else self.active_fps
+        if self.cpu_budget and self.detect_cost:
+            fps = min(fps, max(self.idle_fps, self.cpu_budget / self.detect_cost))
+
+        return fps
+
+    # How many grabbed frames go by for each one that gets decoded, for Camera.decode_every
+    def decode_every(self, now=None) -> int:
+        return max(1, round(self.camera_fps / self.target_fps(now)))
@@ -2,70 +2,143 @@
 Connect to Google Drive API for uploading training data
 """
 
+import io
 import os.path
 import json
 import logging
+import threading
+import time
 from pathlib import Path
 
 from google.oauth2 import service_account
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+from metrics.stats import timed
+
+class CapacityError(Exception):
+    pass
+
 class Drive:
     SCOPES = ['https://www.googleapis.com/auth/drive.file']
     ROOT = os.path.dirname(os.path.abspath(__file__))
     DRIVE_CAPACITY = 2000 # Max number of files allowed to be stored in the drive
 
-    def __init__(self) -> None:
-        with open('../env.json', 'r') as env_file:
-            env = json.load(env_file)
+    RECONCILE_INTERVAL = 3600 # Seconds between recounting the stored files through the API
+    PAGE_SIZE = 1000 # The most files.list will return per page
+
+    # service is the Drive v3 resource to use instead of building one from the credentials in env.json, e.g. a
+    # fake for testing. api_endpoint points the built service somewhere other than Google, e.g. a local
+    # stand-in server, and credentials or http (an httplib2.Http to send requests through unauthenticated)
+    # replace the service account so it can be built without one, see google_drive/stand_in.py.
+    # Between reconciles the file count is only tracked locally, so files removed through the web UI aren't
+    # noticed until the next one.
+    def __init__(
+        self,
+        service=None,
+        training_location_id=None,
+        reconcile_interval=RECONCILE_INTERVAL,
+        api_endpoint=None,
+        credentials=None,
+        http=None
+    ) -> None:
+        needs_credentials = service is None and credentials is None and http is None
+        if training_location_id is None or needs_credentials:
+            with open('../env.json', 'r') as env_file:
+                env = json.load(env_file)
 
-        self.training_location_id = env['TRAINING_LOCATION_ID']
-        service_file = env['SERVICE_FILENAME']
+            training_location_id = training_location_id or env['TRAINING_LOCATION_ID']
+            if needs_credentials:
+                service_file = os.path.join(self.ROOT, 'auth', env['SERVICE_FILENAME'])
+                credentials = service_account.Credentials.from_service_account_file(service_file, scopes=self.SCOPES)
 
-        service = os.path.join(self.ROOT, 'auth', service_file)
-        credentials = service_account.Credentials.from_service_account_file(service, scopes=self.SCOPES)
-        self.drive = build('drive', 'v3', credentials=credentials)
+        if service is None:
+            client_options = {'api_endpoint': api_endpoint} if api_endpoint else None
+            service = build('drive', 'v3', credentials=credentials, http=http, client_options=client_options)
 
-    def over_capacity(self):
+        self.training_location_id = training_location_id
+        self.drive = service
+
+        self.reconcile_interval = reconcile_interval
+        self.count_lock = threading.Lock()
+        self.file_count = None
+        self.last_reconciled = None
+
+    # Count the stored files through the API. Only the ids are requested, at the largest page size, to keep
+    # the number of round trips and the size of the responses down.
+    def count_files(self) -> int:
         files = self.drive.files()
         request = files.list(
             corpora='user',
             supportsAllDrives=True,
             # driveId=self.training_location_id,
             q='trashed = false',
-            includeItemsFromAllDrives=True
+            includeItemsFromAllDrives=True,
+            pageSize=self.PAGE_SIZE,
+            fields='nextPageToken, files(id)'
         )
         file_cnt = 0
         while request is not None:
             res = request.execute()
-            file_cnt += len(res['files'])
+            file_cnt += len(res.get('files', []))
             request = files.list_next(request, res)
 
-        return file_cnt <= self.DRIVE_CAPACITY
+        return file_cnt
+
+    def reconcile_due(self) -> bool:
+        return self.file_count is None or time.monotonic() - self.last_reconciled >= self.reconcile_interval
 
+    def reconcile(self):
+        file_count = self.count_files()
+        with self.count_lock:
+            self.file_count = file_count
+            self.last_reconciled = time.monotonic()
 
+    # If a reconcile fails the cached count is used until the next interval. Without a cached count there's
+    # no way to tell, so the error is raised.
+    def over_capacity(self) -> bool:
+        if self.reconcile_due():
+            try:
+                self.reconcile()
+            except HttpError as e:
+                if self.file_count is None:
+                    raise
+                logging.error(f'Unable to reconcile the Drive file count, using the cached count: {e}')
+                self.last_reconciled = time.monotonic()
+
+        return self.file_count >= self.DRIVE_CAPACITY
+
+    # Upload an image that's already been encoded, e.g. by ImageEncoder.encode, without touching the disk
+    @timed('drive.upload')
+    def upload_bytes(self, data: bytes, name, mimetype='image/jpeg'):
+        media = MediaIoBaseUpload(io.BytesIO(data), mimetype)
+        return self.create_file(name, media)
+
+    # Upload a file from disk. Only used for images that were spooled to disk rather than uploaded straight away.
+    @timed('drive.upload')
     def upload_file(self, filepath):
+        media = MediaFileUpload(filepath, 'image/jpeg')
+        return self.create_file(Path(filepath).name, media)
+
+    def create_file(self, name, media):
         if self.over_capacity():
-            raise Exception('There is no room to store additional images in the selected location.')
+            raise CapacityError('There is no room to store additional images in the selected location.')
 
         metadata = {
-            'name': filepath,
+            'name': name,
             'parents': [self.training_location_id]
         }
-        media = MediaFileUpload(filepath, 'image/jpeg')
 
-        try:
-            file = self.drive.files().create(
-                body=metadata,
-                media_body=media,
-                fields='id'
-            ).execute()
-            logging.info(f'Uploaded File ID: {file.get("id")}')
-        except HttpError as e:
-            logging.error(e)
-            file = None
+        # HttpErrors are left to the caller, the Uploader decides which ones are worth retrying
+        file = self.drive.files().create(
+            body=metadata,
+            media_body=media,
+            fields='id'
+        ).execute()
+        logging.info(f'Uploaded File ID: {file.get("id")}')
+        with self.count_lock:
+            self.file_count += 1
 
         return file.get('id')
 
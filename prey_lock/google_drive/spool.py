@@ -0,0 +1,116 @@
+"""
+Durable spool of images waiting to be uploaded.
+
+Encoded images are kept in a SQLite database until they've made it to Drive, so an outage or a restart doesn't
+lose them. SQLite makes each write atomic, so after an unclean shutdown the spool comes back with every image
+that was fully written and nothing half written. The spool has a byte budget and drops the oldest images when
+it's exceeded, so a long outage can't fill the SD card.
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+
+class UploadSpool:
+    MAX_BYTES = 200 * 1024 * 1024
+
+    def __init__(self, path, max_bytes=MAX_BYTES) -> None:
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        # WAL with synchronous=NORMAL doesn't fsync on every commit. A power cut can lose the last few images
+        # but can't corrupt the database, and writes stay cheap.
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS uploads ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, data BLOB NOT NULL, '
+            'size INTEGER NOT NULL, created REAL NOT NULL)'
+        )
+
+        (self.entries, self.total_bytes) = self.db.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM uploads'
+        ).fetchone()
+        if self.entries:
+            logging.info(f'Upload spool has {self.entries} images ({self.total_bytes} bytes) left from the last run')
+
+    # Add an image to the spool. Returns its id and the ids of any older images dropped to stay in budget.
+    def put(self, data: bytes, name) -> tuple:
+        with self.lock:
+            cursor = self.db.execute(
+                'INSERT INTO uploads (name, data, size, created) VALUES (?, ?, ?, ?)',
+                (name, data, len(data), time.time())
+            )
+            self.entries += 1
+            self.total_bytes += len(data)
+
+            return (cursor.lastrowid, self.evict())
+
+    # Must be called with lock held
+    def evict(self) -> list:
+        evicted = []
+        while self.entries > 1 and self.total_bytes > self.max_bytes:
+            (spool_id, size) = self.db.execute('SELECT id, size FROM uploads ORDER BY id LIMIT 1').fetchone()
+            self.db.execute('DELETE FROM uploads WHERE id = ?', (spool_id,))
+            self.entries -= 1
+            self.total_bytes -= size
+            evicted.append(spool_id)
+
+        if evicted:
+            logging.warning(f'Upload spool over budget, dropped {len(evicted)} oldest images')
+
+        return evicted
+
+    # Oldest images first, as (id, name, data)
+    def peek(self, limit) -> list:
+        with self.lock:
+            return self.db.execute('SELECT id, name, data FROM uploads ORDER BY id LIMIT ?', (limit,)).fetchall()
+
+    def remove(self, spool_id):
+        with self.lock:
+            row = self.db.execute('SELECT size FROM uploads WHERE id = ?', (spool_id,)).fetchone()
+            if row is None:
+                return # Already evicted
+
+            self.db.execute('DELETE FROM uploads WHERE id = ?', (spool_id,))
+            self.entries -= 1
+            self.total_bytes -= row[0]
+
+    # Move an image behind everything else in the spool so it isn't the next one peeked at. Returns its new id,
+    # or None if it had already been evicted.
+    def requeue(self, spool_id):
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                cursor = self.db.execute(
+                    'INSERT INTO uploads (name, data, size, created) '
+                    'SELECT name, data, size, created FROM uploads WHERE id = ?',
+                    (spool_id,)
+                )
+                self.db.execute('DELETE FROM uploads WHERE id = ?', (spool_id,))
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+
+            return cursor.lastrowid if cursor.rowcount else None
+
+    def contains(self, spool_id) -> bool:
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM uploads WHERE id = ?', (spool_id,)).fetchone() is not None
+
+    def count(self) -> int:
+        return self.entries
+
+    def size(self) -> int:
+        return self.total_bytes
+
+    def close(self):
+        with self.lock:
+            self.db.close()
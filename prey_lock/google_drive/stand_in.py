@@ -0,0 +1,202 @@
+"""
+A local stand-in for the parts of the Drive v3 API we use, for running Drive and Uploader end to end without
+Google or any credentials.
+
+StandInServer serves files.list (paged) and multipart files.create on 127.0.0.1 and can be told to fail the
+next few uploads with a given status, so retries and backoff can be exercised. The Drive client always sends
+media uploads to https, so StandInHttp sends requests for the stand-in over plain http instead:
+    server = StandInServer()
+    server.start()
+    drive = Drive(training_location_id='stand-in', api_endpoint=server.api_endpoint, http=StandInHttp(server))
+
+Running this module checks the file count paging and an upload run with failures against it. Run from the
+prey_lock directory:
+    python -m google_drive.stand_in
+"""
+
+import email.parser
+import itertools
+import json
+import logging
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import httplib2
+
+from google_drive.drive import Drive
+from google_drive.spool import UploadSpool
+from google_drive.uploader import Uploader
+
+
+class StandInServer:
+    def __init__(self, files=0) -> None:
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.files = [f'file-{next(self.ids)}' for _ in range(files)] # Ids of the stored files, oldest first
+        self.uploads = [] # (name, parents, bytes of media) for every successful create
+        self.failures = [] # Statuses to answer the next uploads with
+        self.requests = {'list': 0, 'create': 0}
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.httpd.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}/'
+        self.api_endpoint = self.url + 'drive/v3/' # Where the Drive client should send its API calls
+        self.thread = threading.Thread(target=self.httpd.serve_forever, args=(), name='drive_stand_in')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    # Answer the next count uploads with status instead of storing them
+    def fail_uploads(self, status, count=1):
+        with self.lock:
+            self.failures.extend([status] * count)
+
+    def handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path != '/drive/v3/files':
+                    return self.reply(404, {'error': {'code': 404, 'message': 'Not found'}})
+
+                query = parse_qs(url.query)
+                page_size = int(query.get('pageSize', ['100'])[0])
+                start = int(query.get('pageToken', ['0'])[0])
+                with server.lock:
+                    server.requests['list'] += 1
+                    page = server.files[start:start + page_size]
+                    more = start + page_size < len(server.files)
+
+                body = {'files': [{'id': file_id} for file_id in page]}
+                if more:
+                    body['nextPageToken'] = str(start + page_size)
+                self.reply(200, body)
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if url.path != '/upload/drive/v3/files':
+                    return self.reply(404, {'error': {'code': 404, 'message': 'Not found'}})
+
+                with server.lock:
+                    server.requests['create'] += 1
+                    status = server.failures.pop(0) if server.failures else None
+                if status is not None:
+                    return self.reply(status, {'error': {'code': status, 'message': 'Stand-in failure'}})
+
+                # Multipart uploads are the metadata as JSON followed by the media
+                message = email.parser.BytesParser().parsebytes(
+                    f'Content-Type: {self.headers["Content-Type"]}\r\n\r\n'.encode() + body
+                )
+                (metadata_part, media_part) = message.get_payload()
+                metadata = json.loads(metadata_part.get_payload())
+                media = media_part.get_payload(decode=True) or b''
+
+                with server.lock:
+                    file_id = f'file-{next(server.ids)}'
+                    server.files.append(file_id)
+                    server.uploads.append((metadata.get('name'), metadata.get('parents'), len(media)))
+                self.reply(200, {'id': file_id})
+
+            def reply(self, status, body):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+# Sends requests for the stand-in over http. Everything else is left alone.
+class StandInHttp(httplib2.Http):
+    def __init__(self, server: StandInServer, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.https_url = server.url.replace('http://', 'https://', 1)
+        self.http_url = server.url
+
+    def request(self, uri, *args, **kwargs):
+        if uri.startswith(self.https_url):
+            uri = self.http_url + uri[len(self.https_url):]
+
+        return super().request(uri, *args, **kwargs)
+
+
+def stand_in_drive(server: StandInServer, **kwargs) -> Drive:
+    return Drive(
+        training_location_id='stand-in',
+        api_endpoint=server.api_endpoint,
+        http=StandInHttp(server),
+        **kwargs
+    )
+
+
+# Counting a near full Drive takes two pages of ids and nothing more
+def check_count() -> bool:
+    server = StandInServer(files=Drive.DRIVE_CAPACITY - 2)
+    server.start()
+    try:
+        drive = stand_in_drive(server)
+        file_count = drive.count_files()
+        print(f'count: {file_count} files in {server.requests["list"]} requests')
+        return file_count == Drive.DRIVE_CAPACITY - 2 and server.requests['list'] == 2
+    finally:
+        server.stop()
+
+
+# Uploads go through the spool and survive the first few being refused with 503s
+def check_uploads(images=10, failures=3) -> bool:
+    server = StandInServer()
+    server.start()
+    server.fail_uploads(503, failures)
+    with tempfile.TemporaryDirectory() as spool_dir:
+        spool = UploadSpool(str(Path(spool_dir).joinpath('uploads.db')))
+        uploader = Uploader(stand_in_drive(server), backoff_base=0.05, spool=spool)
+        uploader.start()
+        try:
+            futures = [uploader.submit(bytes([i]) * 1024, f'{i}_capture.jpg') for i in range(images)]
+            for future in futures:
+                future.result(timeout=30)
+
+            upload_stats = uploader.stats()
+            print(
+                f"uploads: {len(server.uploads)} stored, {upload_stats['retried']} retried, "
+                f"{upload_stats['failed']} failed, {spool.count()} left in the spool"
+            )
+            return (
+                len(server.uploads) == images
+                and upload_stats['retried'] == failures
+                and spool.count() == 0
+                and all(parents == ['stand-in'] and size == 1024 for (_, parents, size) in server.uploads)
+            )
+        finally:
+            uploader.stop()
+            spool.close()
+            server.stop()
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.WARNING)
+    start = time.perf_counter()
+    passed = check_count() and check_uploads()
+    print(f"{'ok' if passed else 'FAILED'} in {time.perf_counter() - start:.1f}s")
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+"""
+Upload to Drive from a background thread so detection never waits on the network.
+
+Callers only enqueue encoded images. A single thread owns the Drive client (it isn't thread safe), takes jobs off
+the queue in batches and uploads them, retrying transient failures with exponential backoff and jitter.
+Drive's batch endpoint doesn't accept media uploads, so a batch is uploaded as back to back requests over the
+same connection rather than as one batch request.
+
+With a spool the queue lives on disk instead of in memory: jobs survive restarts, transient failures are retried
+until they go through rather than given up on, and anything left from the last run is uploaded first. A spooled
+job that keeps failing for some other reason is moved to the back of the spool so it can't hold up the rest.
+"""
+
+import logging
+import random
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import httplib2
+from google.auth.exceptions import TransportError
+from googleapiclient.errors import HttpError
+
+from google_drive.drive import CapacityError, Drive
+from google_drive.spool import UploadSpool
+from metrics.stats import stats
+
+
+class UploadJob:
+    __slots__ = ('data', 'name', 'future', 'attempts', 'spool_id')
+
+    def __init__(self, data: bytes, name, future=None, spool_id=None) -> None:
+        self.data = data
+        self.name = name
+        self.future = future or Future()
+        self.attempts = 0
+        self.spool_id = spool_id
+
+
+class Uploader:
+    MAX_QUEUE = 32
+    BATCH_SIZE = 8 # Jobs taken off the queue at a time
+    MAX_RETRIES = 5
+    BACKOFF_BASE = 1.0 # Seconds before the first retry, doubled for each one after
+    BACKOFF_MAX = 60.0
+    RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+    THROUGHPUT_WINDOW = 300 # Seconds of recent uploads the throughput is worked out over
+
+    def __init__(
+        self,
+        drive: Drive,
+        max_queue=MAX_QUEUE,
+        batch_size=BATCH_SIZE,
+        max_retries=MAX_RETRIES,
+        backoff_base=BACKOFF_BASE,
+        backoff_max=BACKOFF_MAX,
+        spool: UploadSpool = None
+    ) -> None:
+        self.drive = drive
+        self.spool = spool
+        self.spooled_futures = {} # Spool id -> Future for jobs submitted since this process started
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.queue = deque()
+        self.queue_cond = threading.Condition()
+        self.stopped = threading.Event()
+
+        self.counts = {'uploaded': 0, 'failed': 0, 'retried': 0, 'requeued': 0, 'dropped': 0, 'bytes': 0}
+        self.recent = deque() # (finished at, bytes) for uploads in the throughput window
+
+        self.thread = threading.Thread(target=self.run, args=(), name='uploader')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    # Queue an image for upload and return a Future for the Drive file id. Never waits on the network: if the
+    # queue is full the image is dropped and the future cancelled. With a spool the image is written to it
+    # instead and the oldest spooled images are dropped if that takes it over budget.
+    def submit(self, data: bytes, name) -> Future:
+        job = UploadJob(data, name)
+        with self.queue_cond:
+            if self.stopped.is_set() or (self.spool is None and len(self.queue) >= self.max_queue):
+                self.count('dropped')
+                job.future.cancel()
+                return job.future
+
+            if self.spool is not None:
+                (spool_id, evicted) = self.spool.put(data, name)
+                self.spooled_futures[spool_id] = job.future
+                for evicted_id in evicted:
+                    self.count('dropped')
+                    evicted_future = self.spooled_futures.pop(evicted_id, None)
+                    if evicted_future is not None:
+                        evicted_future.cancel()
+            else:
+                self.queue.append(job)
+
+            self.queue_cond.notify()
+
+        return job.future
+
+    # Must be called with queue_cond held
+    def pending(self) -> int:
+        return self.spool.count() if self.spool is not None else len(self.queue)
+
+    def next_batch(self) -> list:
+        with self.queue_cond:
+            self.queue_cond.wait_for(lambda: self.pending() or self.stopped.is_set())
+            if self.stopped.is_set():
+                return []
+
+            if self.spool is None:
+                batch = []
+                while self.queue and len(batch) < self.batch_size:
+                    batch.append(self.queue.popleft())
+
+                return batch
+
+            # Spooled jobs stay in the spool until they're done with, so a crash mid batch loses nothing
+            batch = []
+            for (spool_id, name, data) in self.spool.peek(self.batch_size):
+                future = self.spooled_futures.pop(spool_id, None)
+                batch.append(UploadJob(data, name, future, spool_id))
+
+            return batch
+
+    def run(self):
+        while not self.stopped.is_set():
+            for job in self.next_batch():
+                if self.stopped.is_set():
+                    break # Whatever is left of a spooled batch is still in the spool for next time
+
+                if job.future.set_running_or_notify_cancel():
+                    self.upload(job)
+                elif job.spool_id is not None:
+                    self.spool.remove(job.spool_id)
+
+    # Without a spool a job is given up on after max_retries. With one, transient failures are retried for as
+    # long as it takes; Drive being unreachable just means the spool fills up until it's back. Anything unexpected
+    # gets max_retries like an unspooled job and then goes to the back of the spool to be tried again later.
+    def upload(self, job: UploadJob):
+        durable = job.spool_id is not None
+        while True:
+            job.attempts += 1
+            try:
+                file_id = self.drive.upload_bytes(job.data, job.name)
+            except Exception as e:
+                final = self.final(e)
+                if self.retryable(e):
+                    retry = durable or job.attempts <= self.max_retries
+                else:
+                    retry = durable and not final and job.attempts <= self.max_retries
+
+                if retry:
+                    if not self.backoff(job.attempts):
+                        # Stopped. A spooled job is picked up again on the next start.
+                        job.future.set_exception(e)
+                        return
+
+                    if durable and not self.spool.contains(job.spool_id):
+                        # Dropped from the spool to make room while we were retrying it
+                        job.future.set_exception(e)
+                        return
+
+                    self.count('retried')
+                    logging.warning(f'Upload of {job.name} failed, retrying (attempt {job.attempts}): {e}')
+                    continue
+
+                if durable and not final:
+                    self.count('requeued')
+                    logging.error(f'Upload of {job.name} failed {job.attempts} times, moving it to the back: {e}')
+                    self.spool.requeue(job.spool_id)
+                    job.future.set_exception(e)
+                    return
+
+                self.count('failed')
+                logging.error(f'Upload of {job.name} failed: {e}')
+                if durable:
+                    self.spool.remove(job.spool_id)
+                job.future.set_exception(e)
+                return
+
+            if durable:
+                self.spool.remove(job.spool_id)
+            self.uploaded(len(job.data))
+            job.future.set_result(file_id)
+            return
+
+    # Failures that are worth waiting out. Connection problems show up as socket errors or wrapped up by httplib2
+    # (DNS failures are ServerNotFoundError) and google-auth (a token refresh that can't reach Google is a
+    # TransportError), and Drive sends 408, 429 and 5xx when it's struggling.
+    def retryable(self, error) -> bool:
+        if isinstance(error, HttpError):
+            status = error.resp.status
+            return status in self.RETRY_STATUSES or not 400 <= status < 500
+
+        return isinstance(error, (
+            ConnectionError, socket.timeout, socket.gaierror, TimeoutError, httplib2.HttpLib2Error, TransportError
+        ))
+
+    # Failures that trying again won't fix: a full Drive and client errors (4xx other than 408 and 429)
+    def final(self, error) -> bool:
+        if isinstance(error, CapacityError):
+            return True
+        if isinstance(error, HttpError):
+            return not self.retryable(error)
+
+        return False
+
+    # Full jitter: sleep a random amount up to the exponential backoff so a burst of failures doesn't retry in
+    # lockstep. Returns False if the uploader was stopped while waiting.
+    def backoff(self, attempt) -> bool:
+        delay = min(self.backoff_max, self.backoff_base * 2 ** min(attempt - 1, 32))
+        return not self.stopped.wait(random.uniform(0, delay))
+
+    def count(self, counter, amount=1):
+        with self.queue_cond:
+            self.counts[counter] += amount
+        stats.count('uploader', counter, amount)
+
+    def uploaded(self, size):
+        now = time.monotonic()
+        with self.queue_cond:
+            self.recent.append((now, size))
+            while self.recent and now - self.recent[0][0] > self.THROUGHPUT_WINDOW:
+                self.recent.popleft()
+        self.count('uploaded')
+        self.count('bytes', size)
+
+    def depth(self) -> int:
+        with self.queue_cond:
+            return self.pending()
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self.queue_cond:
+            recent = [size for (finished, size) in self.recent if now - finished <= self.THROUGHPUT_WINDOW]
+            summary = dict(self.counts)
+            summary['queued'] = self.pending()
+
+        summary['uploads_per_min'] = round(len(recent) * 60 / self.THROUGHPUT_WINDOW, 2)
+        summary['bytes_per_s'] = round(sum(recent) / self.THROUGHPUT_WINDOW, 1)
+        return summary
+
+    # Jobs still queued are cancelled, an upload in flight is allowed to finish. Spooled jobs stay in the spool
+    # for the next run.
+    def stop(self, wait=True):
+        with self.queue_cond:
+            self.stopped.set()
+            for job in self.queue:
+                job.future.cancel()
+            self.queue.clear()
+            for future in self.spooled_futures.values():
+                future.cancel()
+            self.spooled_futures.clear()
+            self.queue_cond.notify_all()
+
+        if wait and self.thread.is_alive():
+            self.thread.join()
@@ -5,13 +5,12 @@ import numpy as np
 import cv2
 import threading
 from queue import Queue
-from pathlib import Path
-from datetime import datetime
 import time
 import json
 
 from interface.detection_zone import DetectionZone
 from detector.camera import Camera
+from detector.capture_store import CaptureStore
 from detector.motion_detector import MotionDetector
 
 class DetectionZoneMonitor:
@@ -22,6 +21,8 @@ class DetectionZoneMonitor:
     DZ_COLOR = (150, 250, 150, 150)
     DETECTION_RESET_TIME = 2 # In seconds
     CAPTURE_PATH = '../captured_images'
+    DETECTOR_CONFIG_PATH = '../config/detector.json'
+    DETECTOR_CONFIG_KEYS = ('analysis_scale', 'bg_mode', 'learning_rate') # Taken from its motion_detector section
     
     def __init__(self, container) -> None:
         self.canvas = Canvas(container, background='#e8e9eb')
@@ -60,20 +61,26 @@ class DetectionZoneMonitor:
         with open(self.CONFIG_PATH, 'r') as f:
             config = json.load(f)
 
-        self.detector: MotionDetector = MotionDetector(config['sensitivity'])
+        with open(self.DETECTOR_CONFIG_PATH, 'r') as f:
+            detector_config = json.load(f)['motion_detector']
+
+        detector_options = {key: detector_config[key] for key in self.DETECTOR_CONFIG_KEYS if key in detector_config}
+        self.detector: MotionDetector = MotionDetector(config['sensitivity'], **detector_options)
         # self.detector.debug = True
         self.detector_frame_cnt = 0
         self.motion_detected = False
 
     def fetch_camera_frame(self):
-        # Warm up the camera stream
-        if not self.cam.frame_ready:
-            time.sleep(1)
-            self.fetch_camera_frame()
-            return
-    
+        seq = 0
         while True:
-            self.frame_queue.put(self.cam.get_frame())
+            # Blocks until there's a new frame so the same frame never gets queued twice
+            next_frame = self.cam.wait_for_frame(seq, timeout=1)
+            if next_frame is None:
+                continue
+
+            seq, _, frame = next_frame
+            # The camera reuses its frame buffers, so queued frames need their own copy
+            self.frame_queue.put(frame.copy())
 
     def refresh_monitor(self):
         if self.frame_queue.empty():
@@ -99,8 +106,15 @@ class DetectionZoneMonitor:
             return
 
         refresh_bg = False
-        frame = self.crop_frame(self.frame)
-        if self.detector_frame_cnt % (self.DETECTION_RESET_TIME * Camera.FPS) == 0:
+        frame = self.frame
+        self.detector.set_detection_zone(
+            self.detection_zone.rel_topleft,
+            self.detection_zone.rel_width,
+            self.detection_zone.rel_height
+        )
+        if self.detector.uses_running_bg():
+            self.detector.set_compare_frame(frame)
+        elif self.detector_frame_cnt % (self.DETECTION_RESET_TIME * Camera.FPS) == 0:
             self.detector.set_bg_frame(frame)
             refresh_bg = True
         else:
@@ -117,22 +131,6 @@ class DetectionZoneMonitor:
 
         self.canvas.master.event_generate("<<detect>>")
 
-    def crop_frame(self, frame: np.ndarray):
-        frame_shape = frame.shape
-        x1 = round(self.detection_zone.rel_topleft[0] * frame_shape[1])
-        y1 = round(self.detection_zone.rel_topleft[1] * frame_shape[0])
-        x2 = round((self.detection_zone.rel_topleft[0] + self.detection_zone.rel_width) * frame_shape[1])
-        y2 = round((self.detection_zone.rel_topleft[1] + self.detection_zone.rel_height) * frame_shape[0])
-
-        # Inspect the cropped frame
-        # cv2.imshow('Test Crop', frame[y1:y2, x1:x2])
-
-        # if cv2.waitKey(Camera.FPS_MS) == 27:
-        #     cv2.destroyAllWindows()
-
-        return frame[y1:y2, x1:x2]
-
-
     def scale_detection_zone(self, event):
         self.detection_zone.update()
         self.bind_detection_zone_events()
@@ -333,7 +331,12 @@ class DetectionZoneMonitor:
     def set_detector_sensitivity(self, sensitivity):
         self.detector.sensitivity = sensitivity
 
+    # Captures go into the same rolling store as the classifier's so they share its budget. The file is
+    # written in the background so the UI doesn't hang while it's encoded.
     def capture_frame(self):
-        cap_file = Path(DetectionZoneMonitor.CAPTURE_PATH).joinpath(datetime.now().strftime('%Y%m%d%H%M%S') + 'capture.jpg')
-        print(f'Saving file: {cap_file}')
-        cv2.imwrite(filename=str(cap_file), img=self.frame)
+        saved = CaptureStore.shared(DetectionZoneMonitor.CAPTURE_PATH).save(self.frame)
+        saved.add_done_callback(self.on_frame_captured)
+
+    def on_frame_captured(self, saved):
+        if not saved.cancelled() and saved.exception() is None:
+            print(f'Saving file: {saved.result()}')
@@ -0,0 +1,253 @@
+"""
+Lightweight timing and counter hooks for the hot path.
+
+Stages are timed with `with stats.time('detector.prepare'):` or by decorating a method with
+`@timed('detector.prepare')`, and counted with `stats.count('camera', 'dropped')`.
+While stats are disabled (the default) time() hands back a shared no-op context manager and count() returns
+straight away, so the hooks can stay in place in production code.
+"""
+
+import bisect
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+
+class StageStats:
+    WINDOW = 1000 # Number of recent samples used for the rolling percentiles
+    # Histogram bucket upper bounds in seconds, matching Prometheus' "le" convention
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.recent = deque(maxlen=self.WINDOW)
+        self.bucket_counts = [0] * (len(self.BUCKETS) + 1) # Last bucket is +Inf
+
+    def record(self, seconds):
+        with self.lock:
+            self.count += 1
+            self.total += seconds
+            self.recent.append(seconds)
+            self.bucket_counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            recent_ms = np.array(self.recent) * 1000
+            buckets = list(self.bucket_counts)
+            count = self.count
+            total = self.total
+
+        snapshot = {
+            'count': count,
+            'total_s': round(total, 6),
+            'buckets': buckets,
+        }
+        if len(recent_ms) > 0:
+            snapshot['p50_ms'] = round(float(np.percentile(recent_ms, 50)), 3)
+            snapshot['p99_ms'] = round(float(np.percentile(recent_ms, 99)), 3)
+            snapshot['max_ms'] = round(float(recent_ms.max()), 3)
+
+        return snapshot
+
+
+class StageTimer:
+    __slots__ = ('stage_stats', 'start')
+
+    def __init__(self, stage_stats: StageStats) -> None:
+        self.stage_stats = stage_stats
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.stage_stats.record(time.perf_counter() - self.start)
+        return False
+
+
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Stats:
+    def __init__(self) -> None:
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counters = {}
+        self.started = time.time()
+        self.sources = []
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.counters = {}
+            self.started = time.time()
+
+    def stage(self, stage) -> StageStats:
+        stage_stats = self.stages.get(stage)
+        if stage_stats is None:
+            with self.lock:
+                stage_stats = self.stages.setdefault(stage, StageStats())
+
+        return stage_stats
+
+    def time(self, stage):
+        if not self.enabled:
+            return NULL_TIMER
+
+        return StageTimer(self.stage(stage))
+
+    def record(self, stage, seconds):
+        if self.enabled:
+            self.stage(stage).record(seconds)
+
+    # Counters are grouped by stage, e.g. count('camera', 'skipped') or count('pool', 'dropped', 3)
+    def count(self, stage, counter, amount=1):
+        if not self.enabled:
+            return
+
+        with self.lock:
+            counters = self.counters.setdefault(stage, {})
+            counters[counter] = counters.get(counter, 0) + amount
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            stages = dict(self.stages)
+            counters = {stage: dict(stage_counters) for stage, stage_counters in self.counters.items()}
+
+        snapshot = {
+            'timestamp': time.time(),
+            'uptime_s': round(time.time() - self.started, 3),
+            'stages': {stage: stage_stats.snapshot() for stage, stage_stats in stages.items()},
+            'counters': counters,
+        }
+        for source in self.sources:
+            for other in source():
+                self.merge(snapshot, other)
+
+        return snapshot
+
+    # source is a callable returning snapshots taken in other processes, e.g. the pipeline's stages, which are
+    # then included in this one's snapshot
+    def add_source(self, source):
+        self.sources.append(source)
+
+    # Counts, totals and histogram buckets add up. Percentiles can't be combined so the worst one is kept.
+    def merge(self, snapshot, other):
+        for stage, other_stats in other['stages'].items():
+            stage_stats = snapshot['stages'].get(stage)
+            if stage_stats is None:
+                snapshot['stages'][stage] = dict(other_stats)
+                continue
+
+            stage_stats['count'] += other_stats['count']
+            stage_stats['total_s'] = round(stage_stats['total_s'] + other_stats['total_s'], 6)
+            stage_stats['buckets'] = [a + b for (a, b) in zip(stage_stats['buckets'], other_stats['buckets'])]
+            for key in ('p50_ms', 'p99_ms', 'max_ms'):
+                if key in other_stats:
+                    stage_stats[key] = max(stage_stats.get(key, 0.0), other_stats[key])
+
+        for stage, other_counters in other['counters'].items():
+            counters = snapshot['counters'].setdefault(stage, {})
+            for counter, value in other_counters.items():
+                counters[counter] = counters.get(counter, 0) + value
+
+    def to_prometheus(self) -> str:
+        snapshot = self.snapshot()
+        lines = ['# TYPE prey_lock_stage_seconds histogram']
+        for stage, stage_stats in snapshot['stages'].items():
+            cumulative = 0
+            bounds = [str(bound) for bound in StageStats.BUCKETS] + ['+Inf']
+            for bound, bucket_count in zip(bounds, stage_stats['buckets']):
+                cumulative += bucket_count
+                lines.append(f'prey_lock_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'prey_lock_stage_seconds_sum{{stage="{stage}"}} {stage_stats["total_s"]}')
+            lines.append(f'prey_lock_stage_seconds_count{{stage="{stage}"}} {stage_stats["count"]}')
+
+        lines.append('# TYPE prey_lock_events_total counter')
+        for stage, counters in snapshot['counters'].items():
+            for counter, value in counters.items():
+                lines.append(f'prey_lock_events_total{{stage="{stage}",event="{counter}"}} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+stats = Stats()
+
+
+def timed(stage):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not stats.enabled:
+                return func(*args, **kwargs)
+
+            with StageTimer(stats.stage(stage)):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class StatsWriter:
+    FORMAT_JSON = 'json'
+    FORMAT_PROMETHEUS = 'prometheus'
+
+    # Periodically write the stats snapshot to path. The file is replaced atomically so readers
+    # (node_exporter's textfile collector, a tail -f) never see a half written file.
+    def __init__(self, path, interval=60, fmt=FORMAT_JSON, source: Stats = stats) -> None:
+        self.path = path
+        self.interval = interval
+        self.format = fmt
+        self.source = source
+        self.stopped = threading.Event()
+
+        self.thread = threading.Thread(target=self.run, args=())
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                logging.error(f'Unable to write stats to {self.path}: {e}')
+
+    def write(self):
+        if self.format == self.FORMAT_PROMETHEUS:
+            content = self.source.to_prometheus()
+        else:
+            content = json.dumps(self.source.snapshot(), indent=4)
+
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as out:
+            out.write(content)
+        os.replace(tmp_path, self.path)
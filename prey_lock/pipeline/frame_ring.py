@@ -0,0 +1,86 @@
+"""
+A ring of frame buffers in shared memory, for passing frames between processes without pickling them.
+
+Frames never travel over a queue, only slot numbers do. A slot is owned by one stage at a time: the capture
+stage takes a free slot and decodes straight into it, then ownership is handed down the pipeline along with a
+small message and the last stage to need the frame puts the slot back on the free queue.
+
+Each slot also has a sequence number. A message carries the sequence number of the frame it refers to, and a
+stage only uses (or frees) a slot if the numbers still match. When a stage crashes the pipeline takes back the
+slots it owned and clears their sequence numbers, so any messages about them still sitting in a queue are
+recognised as stale and ignored rather than freeing a slot twice.
+"""
+
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+
+class FrameRing:
+    FREE = 0 # Owner of a slot nobody is using
+
+    # Create a new ring with slots buffers of up to slot_shape, or attach to an existing one by name
+    def __init__(self, slots, slot_shape, name=None, create=True) -> None:
+        self.slots = slots
+        self.slot_shape = tuple(slot_shape)
+        self.slot_bytes = int(np.prod(self.slot_shape))
+
+        header_bytes = slots * 8 + slots # int64 sequence numbers then int8 owners
+        data_offset = (header_bytes + 63) // 64 * 64
+        size = data_offset + slots * self.slot_bytes
+
+        if create:
+            self.shm = SharedMemory(name=name, create=True, size=size)
+        else:
+            # Stage processes are spawned by the pipeline and share its resource tracker, so attaching only
+            # re-registers a name the tracker already has. The creator is the one that unlinks it.
+            self.shm = SharedMemory(name=name)
+
+        self.name = self.shm.name
+        self.seqs = np.ndarray((slots,), np.int64, buffer=self.shm.buf, offset=0)
+        self.owners = np.ndarray((slots,), np.int8, buffer=self.shm.buf, offset=slots * 8)
+        self.frames = np.ndarray((slots, self.slot_bytes), np.uint8, buffer=self.shm.buf, offset=data_offset)
+
+        if create:
+            self.seqs[:] = 0
+            self.owners[:] = self.FREE
+
+    # Everything a stage process needs to attach to the ring
+    def spec(self) -> tuple:
+        return (self.slots, self.slot_shape, self.name)
+
+    @classmethod
+    def attach(cls, spec) -> 'FrameRing':
+        (slots, slot_shape, name) = spec
+        return cls(slots, slot_shape, name, create=False)
+
+    def fits(self, shape) -> bool:
+        return int(np.prod(shape)) <= self.slot_bytes
+
+    # A frame of shape shape backed by the slot's memory. Nothing is copied.
+    def view(self, slot, shape) -> np.ndarray:
+        return self.frames[slot, :int(np.prod(shape))].reshape(shape)
+
+    def valid(self, slot, seq) -> bool:
+        return seq > 0 and self.seqs[slot] == seq
+
+    def claim(self, slot, owner, seq=None):
+        if seq is not None:
+            self.seqs[slot] = seq
+        self.owners[slot] = owner
+
+    # Clear the slot so outstanding messages about it are stale, ready to go back on the free queue
+    def reset(self, slot):
+        self.seqs[slot] = 0
+        self.owners[slot] = self.FREE
+
+    def owned_by(self, owner) -> list:
+        return [int(slot) for slot in np.flatnonzero(self.owners == owner)]
+
+    def close(self):
+        # The arrays have to go before the memory they point into can be closed
+        self.seqs = self.owners = self.frames = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
@@ -0,0 +1,251 @@
+"""
+Run capture, detection, classification and upload in separate processes so they aren't fighting over the GIL.
+
+Each camera gets a capture process and a detect process with a FrameRing in shared memory between them. One
+classify process encodes the frames worth keeping for every camera and one upload process owns the Drive client.
+Only slot numbers and small messages go over the queues, frames are never pickled.
+
+The pipeline supervises its stages: a stage that dies is restarted after the slots it was holding have been taken
+back, so a crash in one stage costs a few frames rather than the whole daemon.
+
+Nothing a stage shares with the others can be left locked by it dying. multiprocessing.Queue and Event keep their
+locks in shared semaphores, and a stage killed while holding one (which a stage waiting on its inbox nearly always
+is) leaves it held for good: its replacement would never get another message. So the queues are Manager queues,
+whose locks live in the manager's process, and the stop flag is a plain shared value.
+"""
+
+import logging
+import multiprocessing
+import threading
+import time
+
+import cv2
+
+from detector.frame_source import open_source
+from metrics.stats import stats
+from pipeline import stages
+from pipeline.frame_ring import FrameRing
+
+
+class Stage:
+    def __init__(self, name, target, kwargs, owner=None, rings=()) -> None:
+        self.name = name
+        self.target = target
+        self.kwargs = kwargs
+        self.owner = owner # Which slots to take back if it dies
+        self.rings = rings
+        self.process = None
+        self.restarts = 0
+        self.last_start = 0.0
+        self.restart_at = None
+
+
+class Pipeline:
+    RING_SLOTS = 8 # Frames per camera that can be somewhere in the pipeline at once
+    SLOT_SHAPE = (1080, 1920, 3) # Largest frame the ring slots can hold if the camera's size can't be found out
+    RESTART_DELAY = 1.0 # Seconds before restarting a stage, doubled while it keeps crashing soon after starting
+    RESTART_DELAY_MAX = 60.0
+    STABLE_AFTER = 60 # Seconds a stage has to stay up for its restart delay to go back to the start
+    SUPERVISE_INTERVAL = 1.0
+    STOP_TIMEOUT = 5.0
+
+    # sources are the same dicts CameraPool takes. detector_options, sampling and dedup (DuplicateFilter options)
+    # are passed to each detect stage. Without a slot_shape each camera's ring is sized to the frames it reports
+    # when it's opened. Frames that turn out too big for their ring are dropped.
+    def __init__(
+        self,
+        sources: list,
+        detector_options=None,
+        sampling=None,
+        upload_frequency=0,
+        dedup=None,
+        spool_path='./spool/uploads.db',
+        spool_max_bytes=200 * 1024 * 1024,
+        classify=False,
+        quality=90,
+        slot_shape=None,
+        ring_slots=RING_SLOTS,
+        log_path=None
+    ) -> None:
+        # Stage processes are spawned rather than forked, forking a process with threads running isn't safe
+        self.context = multiprocessing.get_context('spawn')
+        self.manager = self.context.Manager()
+        self.stop_flag = self.context.Value('b', 0, lock=False) # Set to 1 to stop every stage
+        self.stop_event = threading.Event() # Wakes the supervisor
+        self.stage_stats = self.manager.dict() # Stage name -> its latest stats snapshot
+        self.stopping = False
+        self.rings = {}
+        self.free_slots = {}
+        self.stages: list[Stage] = []
+
+        classify_inbox = self.manager.Queue()
+        upload_inbox = self.manager.Queue()
+
+        for source in sources:
+            name = source['name']
+            ring = FrameRing(ring_slots, slot_shape or self.source_shape(source['src']))
+            free_slots = self.manager.Queue()
+            for slot in range(ring_slots):
+                free_slots.put(slot)
+
+            detect_inbox = self.manager.Queue()
+            decode_every = self.context.Value('i', 1, lock=False)
+            self.rings[name] = ring
+            self.free_slots[name] = free_slots
+
+            self.stages.append(Stage(f'{name}.capture', stages.capture_stage, {
+                'name': name,
+                'src': source['src'],
+                'ring_spec': ring.spec(),
+                'free_slots': free_slots,
+                'outbox': detect_inbox,
+                'decode_every': decode_every,
+                'stop': self.stop_flag,
+                'log_path': log_path,
+            }, stages.CAPTURE, (name,)))
+
+            self.stages.append(Stage(f'{name}.detect', stages.detect_stage, {
+                'name': name,
+                'config': source['config'],
+                'ring_spec': ring.spec(),
+                'free_slots': free_slots,
+                'inbox': detect_inbox,
+                'outbox': classify_inbox,
+                'decode_every': decode_every,
+                'stop': self.stop_flag,
+                'detector_options': detector_options,
+                'sampling': sampling,
+                'upload_frequency': upload_frequency,
+                'dedup': dedup,
+                'log_path': log_path,
+            }, stages.DETECT, (name,)))
+
+        self.stages.append(Stage('classify', stages.classify_stage, {
+            'ring_specs': {name: ring.spec() for name, ring in self.rings.items()},
+            'free_slots': self.free_slots,
+            'inbox': classify_inbox,
+            'outbox': upload_inbox,
+            'stop': self.stop_flag,
+            'classify': classify,
+            'quality': quality,
+            'log_path': log_path,
+        }, stages.CLASSIFY, tuple(self.rings)))
+
+        self.stages.append(Stage('upload', stages.upload_stage, {
+            'inbox': upload_inbox,
+            'stop': self.stop_flag,
+            'spool_path': spool_path,
+            'spool_max_bytes': spool_max_bytes,
+            'log_path': log_path,
+        }))
+
+        self.supervisor = threading.Thread(target=self.supervise, args=(), name='pipeline_supervisor')
+        self.supervisor.daemon = True
+
+    # Open the source just long enough to ask it its frame size
+    def source_shape(self, src) -> tuple:
+        capture = open_source(src)
+        try:
+            width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+            height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        finally:
+            capture.release()
+
+        if not width or not height:
+            logging.warning(f'Unable to get the frame size of {src}, sizing its ring for {self.SLOT_SHAPE}')
+            return self.SLOT_SHAPE
+
+        return (height, width, 3)
+
+    def start(self):
+        # The stages' stats go out with this process's
+        if stats.enabled:
+            for stage in self.stages:
+                stage.kwargs['stage_stats'] = self.stage_stats
+            stats.add_source(self.stage_snapshots)
+
+        for stage in self.stages:
+            self.start_stage(stage)
+
+        self.supervisor.start()
+
+    def start_stage(self, stage: Stage):
+        stage.process = self.context.Process(target=stage.target, kwargs=stage.kwargs, name=stage.name)
+        stage.process.daemon = True
+        stage.process.start()
+        stage.last_start = time.monotonic()
+
+    def supervise(self):
+        while not self.stop_event.wait(self.SUPERVISE_INTERVAL):
+            for stage in self.stages:
+                if stage.process.is_alive() or self.stopping:
+                    continue
+
+                # A capture stage whose file source ran out of frames exits cleanly and isn't restarted
+                if stage.process.exitcode == 0 and stage.owner == stages.CAPTURE:
+                    continue
+
+                self.restart_stage(stage)
+
+    # Called on every supervise pass while the stage is down. The first pass takes back its slots and schedules
+    # the restart, a stage that keeps crashing soon after starting waits longer each time.
+    def restart_stage(self, stage: Stage):
+        now = time.monotonic()
+        if stage.restart_at is None:
+            if now - stage.last_start >= self.STABLE_AFTER:
+                stage.restarts = 0
+
+            delay = min(self.RESTART_DELAY_MAX, self.RESTART_DELAY * 2 ** stage.restarts)
+            stage.restart_at = now + delay
+            logging.error(
+                f'Pipeline stage {stage.name} exited with code {stage.process.exitcode}, restarting in {delay:.0f}s'
+            )
+            self.reclaim_slots(stage)
+
+        if now >= stage.restart_at:
+            stage.restart_at = None
+            stage.restarts += 1
+            self.start_stage(stage)
+
+    # Put every slot the dead stage was holding back on the free queue. Their sequence numbers are cleared so
+    # messages about them still in a queue are ignored.
+    def reclaim_slots(self, stage: Stage):
+        if stage.owner is None:
+            return
+
+        for name in stage.rings:
+            ring = self.rings[name]
+            for slot in ring.owned_by(stage.owner):
+                ring.reset(slot)
+                self.free_slots[name].put(slot)
+                logging.info(f'Reclaimed slot {slot} of {name} from {stage.name}')
+
+    def stage_snapshots(self) -> list:
+        try:
+            return list(self.stage_stats.values())
+        except (OSError, EOFError):
+            return [] # Stopped
+
+    def alive(self) -> dict:
+        return {stage.name: stage.process is not None and stage.process.is_alive() for stage in self.stages}
+
+    def stop(self):
+        self.stopping = True
+        self.stop_flag.value = 1
+        self.stop_event.set()
+        deadline = time.monotonic() + self.STOP_TIMEOUT
+        for stage in self.stages:
+            if stage.process is None:
+                continue
+
+            stage.process.join(max(0, deadline - time.monotonic()))
+            if stage.process.is_alive():
+                logging.warning(f'Pipeline stage {stage.name} did not stop in time, terminating it')
+                stage.process.terminate()
+                stage.process.join()
+
+        for ring in self.rings.values():
+            ring.close()
+            ring.unlink()
+
+        self.manager.shutdown()
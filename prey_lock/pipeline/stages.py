@@ -0,0 +1,275 @@
+"""
+The stage processes of the multi-process pipeline.
+
+Each function here is the body of one process. They pass slot numbers and small metadata messages between them,
+frames stay in the camera's FrameRing the whole time. Every stage loops until the shared stop flag is set,
+waiting on its inbox with a timeout so it notices.
+"""
+
+import logging
+import queue
+import threading
+import time
+
+from metrics.stats import stats
+from pipeline.frame_ring import FrameRing
+
+# Slot owners in a FrameRing
+CAPTURE = 1
+DETECT = 2
+CLASSIFY = 3
+
+POLL_TIMEOUT = 0.5 # Seconds to wait on a queue before checking for stop
+STATS_INTERVAL = 10 # Seconds between publishing a stage's stats to the pipeline
+
+
+# stage_stats is a shared dict the stage's stats snapshot is published to every STATS_INTERVAL, so the pipeline's
+# process can write them out along with its own
+def init_stage(name, log_path, stage_stats=None):
+    logging.basicConfig(
+        format=f'%(asctime)s [{name}] %(message)s',
+        level=logging.INFO,
+        filename=log_path
+    )
+
+    if stage_stats is not None:
+        stats.enable()
+        publisher = threading.Thread(target=publish_stats, args=(name, stage_stats), name='stats_publisher')
+        publisher.daemon = True
+        publisher.start()
+
+
+def publish_stats(name, stage_stats):
+    while True:
+        time.sleep(STATS_INTERVAL)
+        try:
+            stage_stats[name] = stats.snapshot()
+        except (OSError, EOFError):
+            return # The pipeline has shut down
+
+
+def release_slot(ring: FrameRing, free_slots, slot, seq):
+    # A stale message means the slot was taken back after a crash and is already free
+    if ring.valid(slot, seq):
+        ring.reset(slot)
+        free_slots.put(slot)
+
+
+# Grab frames and decode the ones that are due straight into free slots of the ring. When there's no free slot
+# the frame is dropped; the stages behind are full and queueing more would only add latency.
+# decode_every is a shared value the detect stage adjusts as the scene goes quiet or busy.
+def capture_stage(name, src, ring_spec, free_slots, outbox, decode_every, stop, log_path=None, stage_stats=None):
+    import cv2
+    from detector.frame_source import open_source
+
+    init_stage(f'{name}.capture', log_path, stage_stats)
+    ring = FrameRing.attach(ring_spec)
+    capture = open_source(src)
+    live = getattr(capture, 'live', True)
+
+    seq = int(time.time() * 1000) # Carries on from where a crashed capture stage got to, stale messages stay stale
+    grab_cnt = 0
+    oversized = False # Only logged the first time
+    try:
+        while not stop.value:
+            if not capture.grab():
+                if not live:
+                    logging.info('Source has run out of frames')
+                    break
+                time.sleep(0.1)
+                continue
+
+            grab_cnt += 1
+            every = decode_every.value
+            if every <= 0 or grab_cnt % every != 0:
+                continue
+
+            try:
+                slot = free_slots.get_nowait()
+            except queue.Empty:
+                stats.count(f'pipeline.{name}', 'dropped')
+                continue
+
+            seq += 1
+            ring.claim(slot, CAPTURE, seq)
+            width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+            height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            shape = (height, width, 3)
+            into_slot = width and height and ring.fits(shape)
+            start = time.perf_counter()
+            if into_slot:
+                (ret, frame) = capture.retrieve(ring.view(slot, shape))
+            else:
+                (ret, frame) = capture.retrieve()
+            decode_seconds = time.perf_counter() - start
+
+            if ret and (not into_slot or frame.shape != shape):
+                # retrieve allocated its own buffer, either because the frame is too big for a slot or because
+                # the reported size was off. Copy it in if it fits, otherwise there's nothing to do but drop it.
+                shape = frame.shape
+                if ring.fits(shape):
+                    ring.view(slot, shape)[:] = frame
+                else:
+                    if not oversized:
+                        logging.error(f'Frames of {shape} are too big for the ring slots of {ring.slot_shape}')
+                    oversized = True
+                    stats.count(f'pipeline.{name}', 'oversized')
+                    ret = False
+
+            if not ret:
+                release_slot(ring, free_slots, slot, seq)
+                continue
+
+            ring.claim(slot, DETECT)
+            outbox.put((seq, slot, time.time(), shape, decode_seconds))
+    finally:
+        capture.release()
+        ring.close()
+
+
+# Run motion detection on each frame the capture stage publishes. Motion frames are passed on to the classify
+# stage, at most one every upload_frequency seconds and skipping near duplicates of recent ones, and everything
+# else goes straight back on the free queue.
+def detect_stage(
+    name,
+    config,
+    ring_spec,
+    free_slots,
+    inbox,
+    outbox,
+    decode_every,
+    stop,
+    detector_options=None,
+    sampling=None,
+    upload_frequency=0,
+    dedup=None,
+    log_path=None,
+    stage_stats=None
+):
+    from detector.camera import Camera
+    from detector.camera_pool import CameraStream
+    from detector.dedup import DuplicateFilter
+    from detector.motion_detector import MotionDetector
+    from detector.sampling import AdaptiveSampler
+
+    init_stage(f'{name}.detect', log_path, stage_stats)
+    ring = FrameRing.attach(ring_spec)
+    detector = MotionDetector(config['sensitivity'], **(detector_options or {}))
+    detector.set_detection_zone(config['top_left'], config['width'], config['height'])
+    sampler = AdaptiveSampler(Camera.FPS, **sampling) if sampling is not None else None
+    if sampler is not None:
+        decode_every.value = sampler.decode_every()
+
+    duplicate_filter = DuplicateFilter(**dedup) if dedup is not None else None
+    last_bg_reset = 0.0
+    last_forwarded = 0.0
+    try:
+        while not stop.value:
+            try:
+                (seq, slot, timestamp, shape, decode_seconds) = inbox.get(timeout=POLL_TIMEOUT)
+            except queue.Empty:
+                continue
+
+            if not ring.valid(slot, seq):
+                continue
+
+            start = time.perf_counter()
+            frame = ring.view(slot, shape)
+            if not detector.uses_running_bg() and timestamp - last_bg_reset >= CameraStream.BG_RESET_TIME:
+                last_bg_reset = timestamp
+                detector.set_bg_frame(frame)
+                motion_detected = False
+            else:
+                detector.set_compare_frame(frame)
+                motion_detected = detector.movement_detected()
+            if sampler is not None:
+                # Frames are only decoded to be checked, so decoding counts against the CPU budget too
+                sampler.record(motion_detected, time.perf_counter() - start + decode_seconds)
+                decode_every.value = sampler.decode_every()
+
+            forward = motion_detected and timestamp - last_forwarded >= upload_frequency
+            if forward and duplicate_filter is not None and duplicate_filter.is_duplicate(detector.crop_frame(frame)):
+                forward = False
+                stats.count(f'pipeline.{name}', 'duplicates_skipped')
+
+            if forward:
+                last_forwarded = timestamp
+                ring.claim(slot, CLASSIFY)
+                outbox.put((name, seq, slot, timestamp, shape, detector.motion_regions()))
+            else:
+                release_slot(ring, free_slots, slot, seq)
+    finally:
+        ring.close()
+
+
+# Optionally check motion frames for a cat, then encode them and hand the JPEG bytes to the upload stage.
+# Serves every camera so it attaches to all of their rings.
+def classify_stage(
+    ring_specs,
+    free_slots,
+    inbox,
+    outbox,
+    stop,
+    classify=False,
+    quality=90,
+    log_path=None,
+    stage_stats=None
+):
+    import cv2
+    from detector.cat_classifier import CatClassifier
+
+    init_stage('classify', log_path, stage_stats)
+    rings = {name: FrameRing.attach(spec) for name, spec in ring_specs.items()}
+    classifier = CatClassifier() if classify else None
+    try:
+        while not stop.value:
+            try:
+                (name, seq, slot, timestamp, shape, regions) = inbox.get(timeout=POLL_TIMEOUT)
+            except queue.Empty:
+                continue
+
+            ring = rings[name]
+            if not ring.valid(slot, seq):
+                continue
+
+            try:
+                frame = ring.view(slot, shape)
+                wanted = True
+                if classifier is not None:
+                    classifier.load_frame(frame, regions)
+                    wanted = classifier.is_cat()
+
+                encoded = None
+                if wanted:
+                    (ok, encoded) = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+                    encoded = encoded.tobytes() if ok else None
+            finally:
+                release_slot(ring, free_slots[name], slot, seq)
+
+            if encoded is not None:
+                outbox.put((f'{timestamp}_{name}_capture.jpg', encoded))
+    finally:
+        for ring in rings.values():
+            ring.close()
+
+
+# Own the Drive client and upload whatever the classify stage sends. Images go through the spool so a crash of
+# this stage, or of the whole pipeline, doesn't lose them.
+def upload_stage(inbox, stop, spool_path, spool_max_bytes, log_path=None, stage_stats=None):
+    from google_drive.drive import Drive
+    from google_drive.spool import UploadSpool
+    from google_drive.uploader import Uploader
+
+    init_stage('upload', log_path, stage_stats)
+    uploader = Uploader(Drive(), spool=UploadSpool(spool_path, spool_max_bytes))
+    uploader.start()
+    try:
+        while not stop.value:
+            try:
+                (name, data) = inbox.get(timeout=POLL_TIMEOUT)
+            except queue.Empty:
+                continue
+
+            uploader.submit(data, name)
+    finally:
+        uploader.stop()
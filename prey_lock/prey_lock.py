@@ -1,9 +1,18 @@
 import json
+import threading
 import time
 import cv2
 from detector.camera import Camera
-from detector.motion_detector import MotionDetector
+from detector.camera_pool import CameraStream
+from detector.capture_store import CaptureStore
 from detector.cat_classifier import CatClassifier
+from detector.clip_recorder import ClipRecorder
+from detector.motion_detector import MotionDetector
+from detector.motion_events import EventSegmenter
+from detector.classifier_service import ClassifierService
+
+CHECK_EVERY = Camera.FPS // 2 # Only every nth frame is checked for motion
+FRAME_TIMEOUT = 5.0 # Seconds to wait for a frame before checking whether the camera has gone away
 
 def get_detector_config(cam: Camera):
     with open('./config/detector.json', 'r') as config_file:
@@ -24,6 +33,37 @@ def get_detector_config(cam: Camera):
 
     return config['motion_detector']
 
+def get_classifier_config():
+    with open('./config/detector.json', 'r') as config_file:
+        config = json.load(config_file)
+
+    return config.get('cat_classifier', {})
+
+# The zone in detector.json is in pixels, the detector wants it as fractions of the frame
+def set_detector_zone(detector: MotionDetector, detection_zone: dict, frame_shape):
+    (frame_height, frame_width) = frame_shape[:2]
+    detector.set_detection_zone(
+        (detection_zone['x'] / frame_width, detection_zone['y'] / frame_height),
+        max(0, min(detection_zone['width'], frame_width - detection_zone['x'])) / frame_width,
+        max(0, min(detection_zone['height'], frame_height - detection_zone['y'])) / frame_height
+    )
+
+def show_frame(frame, movement_detected: bool, detection_zone: dict) -> bool:
+    # The frame is the camera's buffer, which the detector and recorder may still be reading
+    frame = frame.copy()
+    if movement_detected:
+        cv2.putText(frame, 'Movement detected!', (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+    else:
+        cv2.putText(frame, 'No movement detected!', (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
+
+    x = detection_zone['x']
+    y = detection_zone['y']
+    cv2.rectangle(frame, (x, y), (x + detection_zone['width'], y + detection_zone['height']), (255, 0, 0), 2)
+    cv2.imshow('Prey Lock', frame)
+
+    # Escape quits
+    return cv2.waitKey(1) != 27
+
 def main():
     with open('env.json') as env_file:
         env = json.load(env_file)
@@ -31,42 +71,89 @@ def main():
     RTSP = f"rtsp://{env['USER']}:{env['PASS']}@{env['RTSP_URL']}"
 
     cam = Camera(RTSP)
-    detector = MotionDetector()
-    detector.debug = True
+    detector_config = get_detector_config(cam)
+    detection_zone = detector_config['detection_zone']
 
     # TODO: configure detector
-    detector_config = get_detector_config(cam)
+    detector = MotionDetector(
+        detector_config['sensitivity'],
+        detector_config['analysis_scale'],
+        detector_config['bg_mode'],
+        detector_config['learning_rate']
+    )
+    detector.debug = True
+
+    classifier = ClassifierService(
+        overflow=ClassifierService.KEEP_LATEST,
+        classifier_config=get_classifier_config()
+    )
+
+    # Frames are only classified here, what gets saved is decided per motion event: if a cat turned up at
+    # any point during it then its best few frames are kept
+    segmenter = EventSegmenter()
+    capture_store = CaptureStore.shared(CatClassifier.CAPTURE_PATH)
+    cat_seen = threading.Event()
+
+    # Keeps a few seconds of video from before the motion so the cat's approach makes it into the clip
+    recorder = ClipRecorder('camera')
+    cam.add_listener(recorder.push)
 
-    classifier = CatClassifier()
+    def on_classified(found_cat: bool):
+        if found_cat:
+            cat_seen.set()
 
-    frame_cnt = 0
+    seq = 0
+    last_checked = -CHECK_EVERY # Seq of the last frame checked for motion. Frames can be skipped so seqs aren't contiguous.
+    last_bg_reset = None
     movement_detected: bool = False
     while True:
-        try:
-            frame = cam.get_frame()
-            frame_cnt += 1
-
-            # Have detector only checking difference every so many frames.
-            if frame_cnt % (cam.FPS / 2) == 0:
-                detector.load_frame(frame)
+        captured = cam.wait_for_frame(seq, FRAME_TIMEOUT)
+        if captured is None:
+            if cam.ended:
+                break
+            continue
+
+        (seq, timestamp, frame) = captured
+        if detector.detection_zone is None:
+            set_detector_zone(detector, detection_zone, frame.shape)
+
+        # Have detector only checking difference every so many frames.
+        if seq - last_checked >= CHECK_EVERY:
+            last_checked = seq
+            # A snapshot background is refreshed every so often, a running one keeps itself up to date
+            if not detector.uses_running_bg() and (
+                last_bg_reset is None or timestamp - last_bg_reset >= CameraStream.BG_RESET_TIME
+            ):
+                detector.set_bg_frame(frame)
+                last_bg_reset = timestamp
+                movement_detected = False
+            else:
+                detector.set_compare_frame(frame)
                 movement_detected = detector.movement_detected()
 
-                # TODO: The classifier should probably be operating in its own thread.
-                if movement_detected:
-                    classifier.load_frame(frame)
-                    classifier.save_img()
-
+            # Classification happens on the service's worker thread so it never holds up the capture loop
             if movement_detected:
-                cam.draw_text('Movement detected!', (0, 255, 0))
-            else:
-                cam.draw_text('No movement detected!', (0, 0, 255))
-
-            # detector.show_diff()
-            detection_zone = detector_config['detection_zone']
-            cam.draw_rect(detection_zone['x'], detection_zone['y'], detection_zone['width'], detection_zone['height'])
-            cam.show_frame()
-        except AttributeError:
-            pass
+                recorder.motion(timestamp)
+                classifier.submit(frame, on_classified, save=False, regions=detector.motion_regions())
+
+            event = segmenter.update(frame, movement_detected, detector.last_percent_moved, timestamp)
+            if event is not None:
+                if cat_seen.is_set():
+                    for (_, _, keyframe) in event.keyframes():
+                        capture_store.save(keyframe)
+                cat_seen.clear()
+
+        if not show_frame(frame, movement_detected, detection_zone):
+            break
+
+    event = segmenter.finish()
+    if event is not None and cat_seen.is_set():
+        for (_, _, keyframe) in event.keyframes():
+            capture_store.save(keyframe)
+
+    recorder.stop()
+    classifier.stop()
+    cam.clean_up()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,157 @@
+"""
+Replay recorded footage through the detection pipeline without a camera or network connection.
+
+Reports throughput, per-stage latency and detection counts. Run from the project root, e.g.
+    python prey_lock/replay.py ./captured_images
+    python prey_lock/replay.py ./recordings/doorway.mp4 --fps 30 --json
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from detector.camera import Camera
+from detector.cat_classifier import CatClassifier
+from detector.frame_source import open_source
+from detector.motion_detector import MotionDetector
+
+CONFIG_PATH = './config/detector.json'
+
+
+class StageTimer:
+    def __init__(self) -> None:
+        self.samples = {}
+
+    def record(self, stage, seconds):
+        self.samples.setdefault(stage, []).append(seconds)
+
+    def summary(self) -> dict:
+        summary = {}
+        for stage, samples in self.samples.items():
+            samples_ms = np.array(samples) * 1000
+            summary[stage] = {
+                'count': len(samples),
+                'p50_ms': round(float(np.percentile(samples_ms, 50)), 3),
+                'p99_ms': round(float(np.percentile(samples_ms, 99)), 3),
+            }
+
+        return summary
+
+
+def get_detector(args) -> MotionDetector:
+    with open(args.config, 'r') as config_file:
+        config = json.load(config_file)['motion_detector']
+
+    detector = MotionDetector(
+        config['sensitivity'],
+        config['analysis_scale'],
+        args.bg_mode or config['bg_mode'],
+        config['learning_rate'],
+        preallocate=True
+    )
+    if args.zone is not None:
+        detector.set_detection_zone(args.zone[:2], args.zone[2], args.zone[3])
+
+    return detector
+
+
+def get_classifier(args) -> CatClassifier:
+    with open(args.config, 'r') as config_file:
+        config = json.load(config_file).get('cat_classifier', {})
+
+    if args.cascade is not None:
+        config['cascade'] = args.cascade
+
+    return CatClassifier(config)
+
+
+def replay(args) -> dict:
+    source = open_source(args.source)
+    detector = get_detector(args)
+    classifier = get_classifier(args) if args.classify else None
+    timer = StageTimer()
+
+    counts = {'frames': 0, 'motion': 0, 'cats': 0}
+    start = time.perf_counter()
+    next_frame = start
+    while True:
+        stage_start = time.perf_counter()
+        (ret, frame) = source.read()
+        if not ret:
+            break
+        timer.record('read', time.perf_counter() - stage_start)
+
+        if counts['frames'] % args.bg_reset == 0 and not detector.uses_running_bg():
+            stage_start = time.perf_counter()
+            detector.set_bg_frame(frame)
+            timer.record('prepare', time.perf_counter() - stage_start)
+            motion_detected = False
+        else:
+            stage_start = time.perf_counter()
+            detector.set_compare_frame(frame)
+            timer.record('prepare', time.perf_counter() - stage_start)
+
+            stage_start = time.perf_counter()
+            motion_detected = detector.movement_detected()
+            timer.record('threshold', time.perf_counter() - stage_start)
+
+        counts['frames'] += 1
+        if motion_detected:
+            counts['motion'] += 1
+
+            if classifier is not None:
+                stage_start = time.perf_counter()
+                classifier.load_frame(frame, detector.motion_regions())
+                if classifier.is_cat():
+                    counts['cats'] += 1
+                timer.record('classify', time.perf_counter() - stage_start)
+
+        if args.fps:
+            next_frame += 1 / args.fps
+            time.sleep(max(0, next_frame - time.perf_counter()))
+
+    elapsed = time.perf_counter() - start
+    source.release()
+
+    return {
+        'source': str(args.source),
+        'elapsed_s': round(elapsed, 3),
+        'fps': round(counts['frames'] / elapsed, 2) if elapsed > 0 else 0.0,
+        'counts': counts,
+        'stages': timer.summary(),
+    }
+
+
+def print_results(results: dict):
+    print(f"{results['source']}: {results['counts']['frames']} frames in {results['elapsed_s']}s ({results['fps']} fps)")
+    print(f"Motion frames: {results['counts']['motion']}, cats: {results['counts']['cats']}")
+    print(f"{'stage':<12}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}")
+    for stage, stats in results['stages'].items():
+        print(f"{stage:<12}{stats['count']:>8}{stats['p50_ms']:>10}{stats['p99_ms']:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a video file or image directory through the detector')
+    parser.add_argument('source', help='Video file or directory of images')
+    parser.add_argument('--fps', type=float, default=0, help='Playback rate, 0 to go as fast as possible')
+    parser.add_argument('--config', default=CONFIG_PATH)
+    parser.add_argument('--bg-mode', choices=[MotionDetector.BG_SNAPSHOT, MotionDetector.BG_RUNNING])
+    parser.add_argument('--bg-reset', type=int, default=Camera.FPS, help='Frames between snapshot background resets')
+    parser.add_argument('--zone', type=float, nargs=4, metavar=('X', 'Y', 'WIDTH', 'HEIGHT'),
+                        help='Detection zone as fractions of the frame size')
+    parser.add_argument('--classify', action='store_true', help='Run the cat classifier on motion frames')
+    parser.add_argument('--cascade', help='Cascade to classify with, overriding the config, e.g. haarcascade_frontalcatface')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    results = replay(args)
+    if args.json:
+        print(json.dumps(results, indent=4))
+    else:
+        print_results(results)
+
+
+if __name__ == '__main__':
+    main()